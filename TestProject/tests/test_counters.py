@@ -0,0 +1,373 @@
+# tests.test_counters.py
+import atexit
+import time
+from unittest.mock import patch
+
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.signals import request_finished
+from django.db import OperationalError
+from django.test import TestCase, TransactionTestCase
+
+from waelstow import capture_stdout
+
+from awl.counters import BlockAllocator, CacheCounter, CounterBuffer
+from awl.models import Counter
+
+# ============================================================================
+
+class CounterBufferTest(TestCase):
+    def test_buffer(self):
+        Counter.objects.create(name='a')
+        Counter.objects.create(name='b', value=10)
+        Counter.objects.create(name='c')
+        Counter.set_shards('c', 2)
+
+        buff = CounterBuffer(max_delay=1000, max_pending=5,
+            flush_on_request_end=False, flush_in_background=False)
+        try:
+            buff.increment('a')
+            buff.increment('a')
+            buff.increment('b', -3)
+            buff.increment('c', 4)
+            self.assertEqual(2, buff.pending('a'))
+
+            # nothing written yet
+            self.assertEqual(0, Counter.get_value('a'))
+
+            # fifth increment passes max_pending and triggers a flush
+            buff.increment('a')
+            self.assertEqual(0, buff.pending('a'))
+            self.assertEqual(3, Counter.get_value('a'))
+            self.assertEqual(7, Counter.get_value('b'))
+            self.assertEqual(4, Counter.get_value('c'))
+
+            # zero sum deltas don't write anything, empty flush is a no-op
+            buff.increment('a', 2)
+            buff.increment('a', -2)
+            with self.assertNumQueries(0):
+                buff.flush()
+                buff.flush()
+
+            # new counters are created
+            buff.increment('a')
+            buff.increment('new')
+            buff.flush()
+
+            self.assertEqual(4, Counter.get_value('a'))
+            self.assertEqual(1, Counter.get_value('new'))
+
+            # failed writes go back into the buffer
+            buff.increment('a')
+            buff.increment('c')
+            with patch.object(Counter, 'add_many', side_effect=OSError):
+                with self.assertRaises(OSError):
+                    buff.flush()
+
+            self.assertEqual(1, buff.pending('a'))
+            self.assertEqual(1, buff.pending('c'))
+            self.assertEqual(4, Counter.get_value('a'))
+
+            # existing un-sharded counters are a single UPDATE, the sharded
+            # one fails after "a" has been written and only it goes back
+            with patch.object(Counter, 'increment_many', side_effect=OSError):
+                with self.assertRaises(OSError):
+                    buff.flush()
+
+            self.assertEqual(0, buff.pending('a'))
+            self.assertEqual(1, buff.pending('c'))
+            self.assertEqual(5, Counter.get_value('a'))
+
+            buff.flush()
+            self.assertEqual(5, Counter.get_value('a'))
+            self.assertEqual(5, Counter.get_value('c'))
+
+            buff.increment('a')
+            buff.increment('b', 2)
+            with self.assertNumQueries(1):
+                buff.flush()
+
+            self.assertEqual(6, Counter.get_value('a'))
+            self.assertEqual(9, Counter.get_value('b'))
+        finally:
+            buff.close()
+
+        # time threshold
+        buff = CounterBuffer(max_delay=0, flush_on_request_end=True,
+            flush_in_background=False)
+        try:
+            buff.increment('a')
+            self.assertEqual(7, Counter.get_value('a'))
+
+            # request end
+            buff.max_delay = 1000
+            buff.increment('a')
+            request_finished.send(sender=self.__class__)
+            self.assertEqual(8, Counter.get_value('a'))
+        finally:
+            buff.close()
+
+        # request end flushing is off by default
+        buff = CounterBuffer(flush_in_background=False)
+        try:
+            buff.increment('a')
+            request_finished.send(sender=self.__class__)
+            self.assertEqual(1, buff.pending('a'))
+        finally:
+            buff.close()
+
+        self.assertEqual(9, Counter.get_value('a'))
+
+
+class CounterBufferBackgroundTest(TransactionTestCase):
+    def wait_for(self, name, value):
+        deadline = time.monotonic() + 5
+        while True:
+            try:
+                if Counter.get_values([name]).get(name) == value:
+                    return
+            except OperationalError:
+                # SQLite's shared in-memory test database locks whole tables
+                # while the background thread writes
+                pass
+
+            if time.monotonic() > deadline:
+                self.fail('Counter "%s" never reached %s' % (name, value))
+
+            time.sleep(0.01)
+
+    def test_background_flush(self):
+        buff = CounterBuffer(max_delay=0.05, flush_on_request_end=False)
+        try:
+            # no thread until there is something to flush
+            self.assertIsNone(buff._thread)
+
+            # written without any further increments arriving
+            buff.increment('a')
+            buff.increment('a')
+            self.assertTrue(buff._thread.is_alive())
+            self.wait_for('a', 2)
+            self.assertEqual(0, buff.pending('a'))
+
+            # thread sticks around for the next batch
+            buff.increment('a', 3)
+            self.wait_for('a', 5)
+
+            # failures are logged and retried
+            with patch.object(Counter, 'add_many',
+                    side_effect=OSError) as add_many:
+                with self.assertLogs('awl.counters', 'ERROR'):
+                    buff.increment('a')
+                    deadline = time.monotonic() + 5
+                    while not add_many.called:
+                        self.assertLess(time.monotonic(), deadline)
+                        time.sleep(0.01)
+
+            self.wait_for('a', 6)
+
+            # stale connections are dealt with before each flush
+            with patch('awl.counters.close_old_connections') as close:
+                buff.increment('a')
+                self.wait_for('a', 7)
+
+            close.assert_called()
+        finally:
+            buff.close()
+
+        self.assertFalse(buff._thread.is_alive())
+
+        # closing stops the thread and flushes straight away
+        buff = CounterBuffer(max_delay=1000, flush_on_request_end=False)
+        buff.increment('b')
+        buff.close()
+        self.assertFalse(buff._thread.is_alive())
+        self.assertEqual(1, Counter.get_value('b'))
+
+        # closed buffers don't restart the thread
+        buff.increment('b')
+        buff.flush()
+        self.assertFalse(buff._thread.is_alive())
+
+
+class BlockAllocatorTest(TestCase):
+    def test_allocator(self):
+        Counter.objects.create(name='seq', value=10)
+
+        alloc = BlockAllocator('seq', block_size=3)
+        with self.assertNumQueries(1):
+            self.assertEqual([11, 12, 13],
+                [alloc.next_value() for _ in range(3)])
+
+        self.assertEqual(14, alloc.next_value())
+        self.assertEqual(16, Counter.get_value('seq'))
+
+        # gaps allowed, release still works if called explicitly
+        self.assertTrue(alloc.release())
+        self.assertEqual(14, Counter.get_value('seq'))
+        self.assertTrue(alloc.release())
+
+        # gapless, but someone else reserved after us so can't give back
+        alloc = BlockAllocator('seq', block_size=5, allow_gaps=False)
+        try:
+            self.assertEqual(15, alloc.next_value())
+            self.assertEqual(range(20, 22), Counter.reserve('seq', 2))
+            self.assertFalse(alloc.release())
+            self.assertEqual(21, Counter.get_value('seq'))
+
+            # new block after a release
+            self.assertEqual(22, alloc.next_value())
+        finally:
+            atexit.unregister(alloc.release)
+
+        # errors
+        for count in [0, -2]:
+            with self.assertRaises(ValueError):
+                Counter.reserve('r', count)
+
+            with self.assertRaises(ValueError):
+                BlockAllocator('r', block_size=count)
+
+        self.assertFalse(Counter.objects.filter(name='r').exists())
+
+        Counter.set_shards('seq', 2)
+        with self.assertRaises(ValueError):
+            Counter.reserve('seq', 3)
+
+
+class CacheCounterTest(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_cache_counter(self):
+        Counter.objects.create(name='a', value=10)
+        Counter.objects.create(name='b')
+
+        counter = CacheCounter()
+        with self.assertNumQueries(1):
+            # cold cache reads from the database once
+            self.assertEqual(11, counter.increment('a'))
+            self.assertEqual(13, counter.increment('a', 2))
+            self.assertEqual(13, counter.get_value('a'))
+
+        # nothing in the database yet
+        self.assertEqual(10, Counter.get_value('a'))
+
+        counter.increment('b', 5)
+        self.assertEqual({'a':3, 'b':5}, counter.reconcile())
+        self.assertEqual(13, Counter.get_value('a'))
+        self.assertEqual(5, Counter.get_value('b'))
+        self.assertEqual({}, counter.reconcile(['a']))
+
+        # warm reads after a reconcile
+        with self.assertNumQueries(0):
+            self.assertEqual(13, counter.get_value('a'))
+
+        # cold read
+        cache.clear()
+        self.assertEqual(13, counter.get_value('a'))
+
+        # failed writes are put back
+        counter.increment('a')
+        with patch.object(Counter, 'increment_many', side_effect=OSError):
+            with self.assertRaises(OSError):
+                counter.reconcile()
+
+        self.assertEqual(14, counter.get_value('a'))
+        self.assertEqual(13, Counter.get_value('a'))
+
+        # periodic reconcile
+        counter = CacheCounter(reconcile_interval=0)
+        self.assertEqual(15, counter.increment('a'))
+        self.assertEqual(15, Counter.get_value('a'))
+
+    def test_negative(self):
+        Counter.objects.create(name='a', value=10)
+        counter = CacheCounter()
+
+        # memcached only stores unsigned numbers and stops decr at 0, make
+        # sure the cache never sees a negative amount or result
+        incr = cache.incr
+
+        def checked(sign):
+            def wrapper(key, delta=1, *args, **kwargs):
+                self.assertGreaterEqual(delta, 0)
+                result = incr(key, sign * delta, *args, **kwargs)
+                self.assertGreaterEqual(result, 0)
+                return result
+
+            return wrapper
+
+        with patch.object(cache, 'incr', checked(1)), \
+                patch.object(cache, 'decr', checked(-1)):
+            self.assertEqual(7, counter.increment('a', -3))
+            self.assertEqual(8, counter.increment('a'))
+            self.assertEqual(3, counter.increment('a', -5))
+            self.assertEqual({'a':-7}, counter.reconcile())
+            self.assertEqual(3, Counter.get_value('a'))
+
+            # pending total below zero, failed writes are put back
+            counter.increment('a', -4)
+            with patch.object(Counter, 'increment_many', side_effect=OSError):
+                with self.assertRaises(OSError):
+                    counter.reconcile()
+
+            self.assertEqual(-1, counter.get_value('a'))
+            self.assertEqual({'a':-4}, counter.reconcile())
+            self.assertEqual(-1, Counter.get_value('a'))
+
+            # amounts that cancel out don't write anything
+            counter.increment('a', 2)
+            counter.increment('a', -2)
+            self.assertEqual({}, counter.reconcile())
+            self.assertEqual(-1, counter.get_value('a'))
+
+    def test_command(self):
+        Counter.objects.create(name='a')
+        CacheCounter().increment('a', 3)
+
+        with capture_stdout() as capture:
+            call_command('reconcile_counters')
+
+        self.assertEqual('a +3\n', capture.getvalue())
+        self.assertEqual(3, Counter.get_value('a'))
+
+        # counters that only exist in the cache are found too
+        CacheCounter().increment('brand-new', 5)
+        with capture_stdout() as capture:
+            call_command('reconcile_counters')
+
+        self.assertEqual('brand-new +5\n', capture.getvalue())
+        self.assertEqual(5, Counter.get_value('brand-new'))
+        self.assertEqual(5, CacheCounter().get_value('brand-new'))
+
+        # other prefixes keep their own names
+        CacheCounter(prefix='other').increment('other-new')
+        call_command('reconcile_counters')
+        self.assertFalse(Counter.objects.filter(name='other-new').exists())
+
+        with capture_stdout() as capture:
+            call_command('reconcile_counters', '--prefix', 'other')
+
+        self.assertEqual('other-new +1\n', capture.getvalue())
+
+
+class UsingTest(TestCase):
+    databases = {'default', 'second'}
+
+    def test_helpers(self):
+        buff = CounterBuffer(flush_on_request_end=False, using='second')
+        buff.increment('a')
+        buff.close()
+        self.assertEqual(1, Counter.get_value('a', using='second'))
+
+        allocator = BlockAllocator('b', block_size=10, using='second')
+        self.assertEqual(1, allocator.next_value())
+        self.assertTrue(allocator.release())
+        self.assertEqual(1, Counter.get_value('b', using='second'))
+
+        counter = CacheCounter(prefix='using-test', using='second')
+        self.assertEqual(2, counter.increment('a'))
+        self.assertEqual({'a':1}, counter.reconcile())
+        self.assertEqual(2, Counter.get_value('a', using='second'))
+
+        self.assertFalse(Counter.objects.exists())
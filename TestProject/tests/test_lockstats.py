@@ -0,0 +1,144 @@
+import json
+from unittest.mock import patch
+
+from django.db import transaction
+from django.test import TestCase, override_settings
+
+from awl.lockstats import LockStats, lock_stats, lock_stats_view
+from awl.models import Counter, Lock, LockContention
+from awl.waelsteng import FakeRequest, create_admin
+
+# ============================================================================
+
+@override_settings(AWL_LOCK_STATS=True)
+class LockStatsTest(TestCase):
+    def setUp(self):
+        lock_stats.reset()
+
+    def tearDown(self):
+        lock_stats.reset()
+
+    def _stats(self):
+        return {(item['kind'], item['name']):item
+            for item in lock_stats.snapshot()}
+
+    @override_settings(AWL_LOCK_STATS=False)
+    def test_disabled(self):
+        Lock.lock_until_commit('a')
+        Counter.increment('c')
+        self.assertEqual([], lock_stats.snapshot())
+
+    def test_buckets(self):
+        stats = LockStats()
+        self.assertEqual(0, stats._bucket(0))
+        self.assertEqual(0, stats._bucket(0.001))
+        self.assertEqual(1, stats._bucket(0.002))
+        self.assertEqual(7, stats._bucket(5))
+        self.assertEqual(8, stats._bucket(60))
+
+    def test_record(self):
+        stats = LockStats()
+        with patch('awl.lockstats.time.monotonic', return_value=10.0):
+            with self.captureOnCommitCallbacks(execute=False) as callbacks:
+                stats.record('lock', 'a', 9.0)
+                stats.record('lock', ['a', 'b'], 10.0)
+                stats.record('lock', 'b', 9.9995, acquired=False)
+
+        # failed attempt doesn't register a hold
+        self.assertEqual(2, len(callbacks))
+
+        result = {item['name']:item for item in stats.snapshot()}
+        self.assertEqual(['a', 'b'], [item['name'] for item in
+            stats.snapshot()])
+
+        a = result['a']
+        self.assertEqual(2, a['acquires'])
+        self.assertEqual(1, a['contended'])
+        self.assertEqual(0, a['failed'])
+        self.assertEqual(1.0, a['wait_total'])
+        self.assertEqual(1.0, a['wait_max'])
+        self.assertEqual([1, 0, 0, 0, 0, 0, 1, 0, 0], a['wait_histogram'])
+
+        b = result['b']
+        self.assertEqual(2, b['acquires'])
+        self.assertEqual(1, b['contended'])
+        self.assertEqual(1, b['failed'])
+        self.assertEqual(0, b['holds'])
+
+        # commit ends the holds
+        with patch('awl.lockstats.time.monotonic', return_value=10.02):
+            for callback in callbacks:
+                callback()
+
+        result = {item['name']:item for item in stats.snapshot()}
+        self.assertEqual(2, result['a']['holds'])
+        self.assertAlmostEqual(0.04, result['a']['hold_total'])
+        self.assertAlmostEqual(0.02, result['a']['hold_max'])
+        self.assertEqual([0, 0, 0, 2, 0, 0, 0, 0, 0],
+            result['a']['hold_histogram'])
+        self.assertEqual(1, result['b']['holds'])
+
+        stats.reset()
+        self.assertEqual([], stats.snapshot())
+
+    def test_lock(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                Lock.lock_until_commit('a')
+                Lock.lock_until_commit('a', skip_locked=True)
+                Lock.lock_many(['c', 'b'])
+
+        # second lock of "a" is served without going to the database
+        stats = self._stats()
+        self.assertEqual(1, stats[('lock', 'a')]['acquires'])
+        self.assertEqual(1, stats[('lock', 'a')]['holds'])
+        self.assertEqual(1, stats[('lock', 'b')]['acquires'])
+        self.assertEqual(1, stats[('lock', 'c')]['holds'])
+
+        # skipped and contended attempts count as failures
+        with patch.object(Lock, '_select_lock', return_value=False):
+            self.assertFalse(Lock.lock_until_commit('a', skip_locked=True))
+
+        with patch.object(Lock, '_lock_nowait', side_effect=LockContention):
+            with self.assertRaises(LockContention):
+                Lock.lock_until_commit('a', nowait=True)
+
+        item = self._stats()[('lock', 'a')]
+        self.assertEqual(3, item['acquires'])
+        self.assertEqual(2, item['failed'])
+        self.assertLessEqual(2, item['contended'])
+
+    def test_counter(self):
+        Counter.increment('c')
+        Counter.set_shards('s', 2)
+        Counter.increment('s')
+        Counter.increment_many({'c':1, 'd':1})
+
+        stats = self._stats()
+        self.assertEqual(2, stats[('counter', 'c')]['acquires'])
+        self.assertEqual(1, stats[('counter', 's')]['acquires'])
+
+        # "d" is created and goes through increment()
+        self.assertEqual(1, stats[('counter', 'd')]['acquires'])
+
+    async def test_counter_async(self):
+        await Counter.aincrement('c')
+        await Counter.aincrement('c', 2)
+        self.assertEqual(2, self._stats()[('counter', 'c')]['acquires'])
+
+    def test_view(self):
+        Lock.lock_until_commit('a')
+
+        admin = create_admin()
+        response = lock_stats_view(FakeRequest(user=admin))
+        self.assertEqual(200, response.status_code)
+        data = json.loads(response.content)
+        self.assertEqual(list(LockStats.BUCKETS), data['buckets'])
+        self.assertEqual('a', data['stats'][0]['name'])
+
+        request = FakeRequest(user=admin, data={'format':'text'})
+        response = lock_stats_view(request)
+        self.assertEqual('text/plain', response['Content-Type'])
+        lines = response.content.decode('utf-8').splitlines()
+        self.assertEqual(2, len(lines))
+        self.assertTrue(lines[1].startswith('lock     a '))
@@ -1,7 +1,31 @@
 # tests.test_models.py
-from django.test import TestCase
+import asyncio
+import json
+import threading
+import time
+import uuid
+from datetime import (date, datetime, time as dt_time, timedelta,
+    timezone as dt_timezone)
+from decimal import Decimal
+from types import SimpleNamespace
+from unittest.mock import patch
 
-from awl.models import Counter, Lock, Choices, QuerySetChain
+from asgiref.sync import sync_to_async
+from django.core.management import call_command
+from django.db import (connection, transaction, IntegrityError,
+    OperationalError)
+from django.db.models import QuerySet
+from django.db.transaction import TransactionManagementError
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from waelstow import capture_stdout
+
+from awl.models import (Counter, CounterShard, CounterSnapshot, RateCounter,
+    Lock, LockContention, Choices, QuerySetChain)
+from awl.models import (_decode_cursor_value, _encode_cursor_value,
+    _share_clause, _shared_lock_sql)
 from awl.utils import refetch
 
 # ============================================================================
@@ -13,11 +37,498 @@ class ModelsTest(TestCase):
         count = refetch(count)
         self.assertEqual(1, count.value)
 
+    def test_counter_delta(self):
+        Counter.objects.create(name='foo', value=10)
+        self.assertEqual(15, Counter.increment('foo', 5))
+        self.assertEqual(12, Counter.increment('foo', -3))
+        self.assertEqual(12, Counter.objects.get(name='foo').value)
+
+        # check the fallback path for backends without UPDATE ... RETURNING
+        with patch('awl.models._can_update_returning', return_value=False):
+            self.assertEqual(13, Counter.increment('foo'))
+
+    def test_counter_create(self):
+        # counters are created on first use
+        self.assertEqual(3, Counter.increment('foo', 3))
+        with patch('awl.models._can_update_returning', return_value=False):
+            self.assertEqual(-1, Counter.increment('bar', -1))
+
+        Counter.set_shards('baz', 2)
+        self.assertEqual(2, Counter.increment('baz', 2))
+        self.assertEqual({'foo':4, 'qux':5},
+            Counter.increment_many({'foo':1, 'qux':5}))
+        self.assertEqual(range(1, 3), Counter.reserve('seq', 2))
+
+        # names are unique
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic():
+                Counter.objects.create(name='foo')
+
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic():
+                Lock.objects.create(name='foo')
+                Lock.objects.create(name='foo')
+
+    def test_counter_shards(self):
+        Counter.objects.create(name='foo', value=10)
+        Counter.set_shards('foo', 4)
+        self.assertEqual(4, CounterShard.objects.count())
+        self.assertEqual(10, Counter.get_value('foo'))
+
+        # random shard
+        self.assertEqual(11, Counter.increment('foo'))
+        self.assertEqual(10, Counter.increment('foo', -1))
+        CounterShard.objects.update(value=0)
+
+        self.assertEqual(11, Counter.increment('foo', shard=0))
+        self.assertEqual(16, Counter.increment('foo', 5, shard=6))
+        self.assertEqual(5, CounterShard.objects.get(index=2).value)
+
+        with patch('awl.models._can_update_returning', return_value=False):
+            self.assertEqual(14, Counter.increment('foo', -2, shard=1))
+
+        # parent row keeps its original value, shards hold the rest
+        self.assertEqual(10, Counter.objects.get(name='foo').value)
+
+        # shrink, removed shards get folded into the parent
+        Counter.set_shards('foo', 2)
+        self.assertEqual(2, CounterShard.objects.count())
+        self.assertEqual(14, Counter.get_value('foo'))
+
+        # back to a single row
+        Counter.set_shards('foo', 0)
+        self.assertEqual(0, CounterShard.objects.count())
+        self.assertEqual(14, Counter.objects.get(name='foo').value)
+        self.assertEqual(15, Counter.increment('foo'))
+
+        with self.assertRaises(Counter.DoesNotExist):
+            Counter.get_value('missing')
+
+    def test_counter_many(self):
+        Counter.objects.create(name='a', value=1)
+        Counter.objects.create(name='b', value=2)
+        Counter.objects.create(name='c', value=3)
+        Counter.set_shards('c', 2)
+
+        self.assertEqual({}, Counter.increment_many({}))
+
+        # savepoint, lock select, update, sharded select, shard update,
+        # result select, release savepoint
+        with self.assertNumQueries(7):
+            result = Counter.increment_many({'a':1, 'b':-2, 'c':10})
+
+        self.assertEqual({'a':2, 'b':0, 'c':13}, result)
+        self.assertEqual({'a':2, 'c':13},
+            Counter.get_values(['a', 'c', 'missing']))
+
+        # counter that was un-sharded after being looked up
+        def unshard(*args):
+            Counter.set_shards('c', 0)
+            return False
+
+        with patch.object(Counter, '_add_to_shard', side_effect=unshard):
+            result = Counter.increment_many({'c':1})
+
+        self.assertEqual({'c':14}, result)
+
+    async def test_counter_async(self):
+        self.assertEqual(3, await Counter.aincrement('foo', 3))
+        self.assertEqual(1, await Counter.aincrement('foo', -2))
+
+        await sync_to_async(Counter.set_shards)('foo', 2)
+        self.assertEqual(6, await Counter.aincrement('foo', 5, shard=1))
+        self.assertEqual(6, await Counter.aget_value('foo'))
+        self.assertEqual({'foo':6}, await Counter.aget_values(['foo', 'x']))
+
+        with self.assertRaises(Counter.DoesNotExist):
+            await Counter.aget_value('missing')
+
+    def test_rate_counter(self):
+        when = datetime(2026, 10, 18, 14, 5, 30, tzinfo=dt_timezone.utc)
+        minute = datetime(2026, 10, 18, 14, 5, tzinfo=dt_timezone.utc)
+        hour = datetime(2026, 10, 18, 14, tzinfo=dt_timezone.utc)
+
+        with self.assertNumQueries(1):
+            RateCounter.increment('foo', when=when,
+                resolutions=[RateCounter.MINUTE, RateCounter.HOUR])
+
+        RateCounter.increment('foo', 2, when=when + timedelta(seconds=10))
+        RateCounter.increment('foo', 4, when=when + timedelta(minutes=2))
+        RateCounter.increment('bar', when=when)
+
+        self.assertEqual(3, RateCounter.objects.get(name='foo',
+            resolution=RateCounter.MINUTE, start=minute).value)
+        self.assertEqual(1, RateCounter.objects.get(name='foo',
+            resolution=RateCounter.HOUR, start=hour).value)
+
+        # series with zero fill
+        series = RateCounter.series('foo', RateCounter.MINUTE, when,
+            minute + timedelta(minutes=3))
+        self.assertEqual([
+            (minute, 3),
+            (minute + timedelta(minutes=1), 0),
+            (minute + timedelta(minutes=2), 4),
+        ], series)
+
+        # rollup of minutes into hours, incomplete hours are left alone
+        self.assertEqual(0, RateCounter.rollup(RateCounter.MINUTE,
+            RateCounter.HOUR, before=when))
+        self.assertEqual(2, RateCounter.rollup(RateCounter.MINUTE,
+            RateCounter.HOUR, before=hour + timedelta(hours=1), name='foo'))
+
+        self.assertEqual(8, RateCounter.objects.get(name='foo',
+            resolution=RateCounter.HOUR, start=hour).value)
+        self.assertFalse(RateCounter.objects.filter(name='foo',
+            resolution=RateCounter.MINUTE).exists())
+        self.assertTrue(RateCounter.objects.filter(name='bar',
+            resolution=RateCounter.MINUTE).exists())
+
+        # pruning
+        self.assertEqual(0, RateCounter.prune(RateCounter.HOUR, hour))
+        self.assertEqual(1, RateCounter.prune(RateCounter.MINUTE,
+            hour + timedelta(hours=1), name='bar'))
+        self.assertEqual(1, RateCounter.prune(RateCounter.HOUR,
+            hour + timedelta(hours=1)))
+        self.assertFalse(RateCounter.objects.exists())
+
+        # default time, naive times
+        RateCounter.increment('foo')
+        with override_settings(USE_TZ=False):
+            RateCounter.increment('foo', when=datetime(2026, 10, 18, 14, 5))
+
+        # backends without upsert
+        features = connection.features
+        with patch.object(features, 'supports_update_conflicts', False), \
+                patch.object(features, 'supports_update_conflicts_with_target',
+                    False):
+            RateCounter.increment('baz', when=when)
+            RateCounter.increment('baz', when=when)
+
+            # concurrent creation
+            with patch.object(QuerySet, 'update', side_effect=[0, 1]):
+                RateCounter.increment('baz', when=when)
+
+        self.assertEqual(2, RateCounter.objects.get(name='baz').value)
+
+    def test_counter_snapshot(self):
+        Counter.increment('a')
+        Counter.increment('b', 5)
+        Counter.set_shards('b', 2)
+
+        start = datetime(2020, 1, 1, 12, 0, tzinfo=dt_timezone.utc)
+        minute = timedelta(minutes=1)
+
+        with self.assertNumQueries(2):
+            self.assertEqual(2, CounterSnapshot.take(when=start))
+
+        Counter.increment('a', 2)
+        Counter.increment('b', 3)
+        with self.assertNumQueries(2):
+            self.assertEqual(1, CounterSnapshot.take(['b', 'missing'],
+                when=start + minute))
+
+        Counter.increment('b', 4)
+        CounterSnapshot.take(when=start + 2 * minute)
+
+        self.assertEqual([(start, 5), (start + minute, 8)],
+            CounterSnapshot.series('b', start, start + 2 * minute))
+        self.assertEqual([], CounterSnapshot.series('b', start - minute,
+            start))
+
+        self.assertEqual(7, CounterSnapshot.delta('b', start,
+            start + 2 * minute))
+        self.assertEqual(3, CounterSnapshot.delta('b', start + 30 * minute /
+            60, start + 90 * minute / 60))
+        self.assertEqual(2, CounterSnapshot.delta('a', start,
+            start + 5 * minute))
+
+        # no snapshot before the start, first one in the range is used
+        self.assertEqual(7, CounterSnapshot.delta('b', start - minute,
+            start + 2 * minute))
+        self.assertIsNone(CounterSnapshot.delta('b', start - 2 * minute,
+            start - minute))
+        self.assertIsNone(CounterSnapshot.delta('missing', start,
+            start + minute))
+
+        # cadence
+        self.assertEqual(1, CounterSnapshot.maybe_take(interval=60,
+            names=['a']))
+        self.assertEqual(0, CounterSnapshot.maybe_take(interval=60,
+            names=['a']))
+        self.assertEqual(0, CounterSnapshot.maybe_take(interval=60))
+        self.assertEqual(6, CounterSnapshot.objects.count())
+
+        # retention
+        self.assertEqual(1, CounterSnapshot.prune(start + minute, name='a'))
+        self.assertEqual(4, CounterSnapshot.prune(start + 3 * minute))
+        self.assertEqual(1, CounterSnapshot.objects.count())
+
+        # command, too soon for "a" and "b" is new
+        with capture_stdout() as capture:
+            call_command('snapshot_counters', interval=60, keep=7)
+
+        self.assertEqual('took 0 snapshots\npruned 0 snapshots\n',
+            capture.getvalue())
+
+        with capture_stdout() as capture:
+            call_command('snapshot_counters', 'b')
+
+        self.assertEqual('took 1 snapshots\n', capture.getvalue())
+        self.assertEqual(2, CounterSnapshot.objects.count())
+
     def test_lock(self):
         # not much to test here except that it doesn't blow up
         Lock.objects.create(name='foo')
         Lock.lock_until_commit('foo')
 
+        # created on first use
+        Lock.lock_until_commit('bar')
+        self.assertTrue(Lock.objects.filter(name='bar').exists())
+
+    def test_lock_options(self):
+        # SQLite has no row locks so everything succeeds
+        self.assertTrue(Lock.lock_until_commit('foo', nowait=True))
+        self.assertTrue(Lock.lock_until_commit('bar', skip_locked=True))
+        self.assertTrue(Lock.lock_until_commit('foo', timeout=1))
+
+        # simulate contention, "foo" is now held so use a different lock
+        Lock.objects.create(name='baz')
+        error = OperationalError('could not obtain lock')
+        with patch.object(Lock, '_select_lock', side_effect=error):
+            with self.assertRaises(LockContention):
+                Lock.lock_until_commit('baz', nowait=True)
+
+        # row exists but is skipped over by SKIP LOCKED
+        with patch.object(QuerySet, 'select_for_update',
+                return_value=Lock.objects.none()):
+            self.assertFalse(Lock.lock_until_commit('baz', skip_locked=True))
+
+        # polling for backends without a server side lock timeout
+        features = connection.features
+        with patch.object(features, 'has_select_for_update_nowait', True):
+            with patch.object(Lock, '_select_lock', side_effect=error):
+                with self.assertRaises(LockContention):
+                    Lock.lock_until_commit('baz', timeout=0.05)
+
+            with patch.object(Lock, '_select_lock',
+                    side_effect=[error, error, True]) as mock:
+                self.assertTrue(Lock.lock_until_commit('baz', timeout=5))
+                self.assertEqual(3, mock.call_count)
+
+    def test_lock_many(self):
+        Lock.objects.create(name='b')
+
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual([], Lock.lock_many(['b']))
+
+        self.assertEqual(1, len(context.captured_queries))
+        self.assertIn('ORDER BY', context.captured_queries[0]['sql'])
+
+        self.assertEqual(['a', 'c'], Lock.lock_many(['c', 'b', 'a', 'c']))
+        self.assertEqual(3, Lock.objects.count())
+
+        with self.assertRaises(Lock.DoesNotExist):
+            Lock.lock_many(['a', 'd'], create=False)
+
+        self.assertFalse(Lock.objects.filter(name='d').exists())
+
+    def test_lock_shared(self):
+        # SQLite falls back to an exclusive lock
+        self.assertTrue(Lock.lock_until_commit('foo', shared=True))
+        self.assertTrue(Lock.lock_until_commit('foo', shared=True,
+            skip_locked=True))
+
+        # backends with shared locks
+        self.assertEqual('FOR SHARE', _share_clause(
+            SimpleNamespace(vendor='postgresql')))
+        self.assertEqual('FOR SHARE', _share_clause(
+            SimpleNamespace(vendor='mysql', mysql_is_mariadb=False)))
+        self.assertEqual('LOCK IN SHARE MODE', _share_clause(
+            SimpleNamespace(vendor='mysql', mysql_is_mariadb=True)))
+        self.assertIsNone(_share_clause(connection))
+
+        rows = Lock.objects.filter(name='foo').values_list('id', flat=True)
+        sql, params = _shared_lock_sql(rows, 'FOR SHARE', nowait=True)
+        self.assertTrue(sql.endswith(' FOR SHARE NOWAIT'))
+        self.assertEqual(('foo', ), tuple(params))
+        sql, params = _shared_lock_sql(rows, 'FOR SHARE', skip_locked=True)
+        self.assertTrue(sql.endswith(' FOR SHARE SKIP LOCKED'))
+
+        # run the hand built query path, SQLite doesn't understand the
+        # locking clause so use an empty one
+        with patch('awl.models._share_clause', return_value=' '):
+            self.assertTrue(Lock.lock_until_commit('foo', shared=True))
+            self.assertTrue(Lock.lock_until_commit('bar', shared=True))
+
+            with patch.object(connection, 'get_autocommit', return_value=True):
+                with self.assertRaises(TransactionManagementError):
+                    Lock.lock_until_commit('baz', shared=True)
+
+    def test_lock_outside_transaction(self):
+        # databases with row locks refuse before any of the paths that use
+        # their own savepoint could commit and release the lock
+        features = connection.features
+        with patch.object(connection, 'in_atomic_block', False), \
+                patch.object(features, 'has_select_for_update', True):
+            for kwargs in [{}, {'nowait':True}, {'timeout':1},
+                    {'skip_locked':True}, {'shared':True}]:
+                with patch.object(Lock, '_select_lock') as select:
+                    with self.assertRaises(TransactionManagementError):
+                        Lock.lock_until_commit('foo', **kwargs)
+
+                    select.assert_not_called()
+
+    def test_lock_reentrant(self):
+        Lock.lock_until_commit('foo')
+
+        # already held by this transaction, no need to ask again
+        with self.assertNumQueries(0):
+            self.assertTrue(Lock.lock_until_commit('foo'))
+            self.assertTrue(Lock.lock_until_commit('foo', nowait=True))
+            self.assertTrue(Lock.lock_until_commit('foo', shared=True))
+            self.assertEqual([], Lock.lock_many(['foo']))
+
+        # a shared lock doesn't cover an exclusive one
+        Lock.lock_until_commit('bar', shared=True)
+        with self.assertNumQueries(0):
+            Lock.lock_until_commit('bar', shared=True)
+
+        with self.assertNumQueries(1):
+            Lock.lock_until_commit('bar')
+
+        with self.assertNumQueries(0):
+            Lock.lock_until_commit('bar')
+
+        # lock_many() only queries for locks not yet held
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(['baz'], Lock.lock_many(['foo', 'baz']))
+
+        self.assertNotIn('"foo"', str(context.captured_queries))
+        with self.assertNumQueries(0):
+            Lock.lock_until_commit('baz')
+
+        # rolling back a savepoint releases locks taken inside it
+        Lock.objects.create(name='qux')
+        try:
+            with transaction.atomic():
+                Lock.lock_until_commit('qux')
+                with self.assertNumQueries(0):
+                    Lock.lock_until_commit('qux')
+
+                raise ValueError()
+        except ValueError:
+            pass
+
+        with self.assertNumQueries(1):
+            Lock.lock_until_commit('qux')
+
+        # locks taken in a savepoint that is released are still held
+        with transaction.atomic():
+            Lock.lock_until_commit('quux')
+
+        with self.assertNumQueries(0):
+            Lock.lock_until_commit('quux')
+
+        # committing forgets everything, fake it by running the hooks
+        for callback in connection.run_on_commit:
+            callback[1]()
+
+        with self.assertNumQueries(1):
+            Lock.lock_until_commit('foo')
+
+    def test_lease(self):
+        owner = Lock.acquire_lease('foo', 60)
+        self.assertIsNotNone(owner)
+        self.assertIsNone(Lock.acquire_lease('foo', 60))
+
+        # holder can re-acquire and renew
+        self.assertEqual(owner, Lock.acquire_lease('foo', 60, owner=owner))
+        self.assertTrue(Lock.renew_lease('foo', owner, 60))
+        self.assertFalse(Lock.renew_lease('foo', 'other', 60))
+
+        # expired leases can be stolen
+        Lock.objects.filter(name='foo').update(
+            expires=timezone.now() - timedelta(seconds=1))
+        thief = Lock.acquire_lease('foo', 60)
+        self.assertIsNotNone(thief)
+        self.assertFalse(Lock.renew_lease('foo', owner, 60))
+        self.assertFalse(Lock.release_lease('foo', owner))
+        self.assertTrue(Lock.release_lease('foo', thief))
+
+        # context manager, renewed by hand
+        with Lock.lease('foo', ttl=60, heartbeat=0) as lease:
+            self.assertTrue(lease.renew())
+            with self.assertRaises(LockContention):
+                with Lock.lease('foo'):
+                    pass
+
+            # lose the lease
+            Lock.objects.filter(name='foo').update(owner='other')
+            self.assertFalse(lease.renew())
+            self.assertTrue(lease.lost)
+
+        self.assertEqual('other', Lock.objects.get(name='foo').owner)
+
+        with Lock.lease('bar', heartbeat=0) as lease:
+            self.assertEqual(lease.owner, Lock.objects.get(name='bar').owner)
+
+        self.assertEqual('', Lock.objects.get(name='bar').owner)
+
+        # lost the race to create the lock
+        with patch.object(QuerySet, 'update', return_value=0):
+            self.assertIsNone(Lock.acquire_lease('baz', 60))
+
+    async def test_lock_async(self):
+        async with Lock.alock('foo'):
+            await Counter.aincrement('foo')
+
+        self.assertTrue(await Lock.objects.filter(name='foo').aexists())
+        self.assertEqual(1, await Counter.aget_value('foo'))
+
+        # exceptions roll back
+        with self.assertRaises(ValueError):
+            async with Lock.alock('foo'):
+                await Counter.aincrement('foo')
+                raise ValueError()
+
+        self.assertEqual(1, await Counter.aget_value('foo'))
+
+        async with Lock.alock('foo', skip_locked=True) as acquired:
+            self.assertTrue(acquired)
+
+        # problems getting the lock close the transaction
+        with patch.object(Lock, 'lock_until_commit', side_effect=OSError):
+            with self.assertRaises(OSError):
+                async with Lock.alock('foo'):
+                    pass
+
+        # nested blocks are fine, concurrent ones in the same request aren't
+        async with Lock.alock('foo'):
+            async with Lock.alock('bar') as acquired:
+                self.assertTrue(acquired)
+
+        async def hold(name):
+            async with Lock.alock(name):
+                await asyncio.sleep(0.01)
+
+            return name
+
+        result = await asyncio.gather(hold('foo'), hold('bar'),
+            return_exceptions=True)
+        self.assertEqual('foo', result[0])
+        self.assertIsInstance(result[1], TransactionManagementError)
+
+        async with Lock.alock('foo'):
+            result = await asyncio.gather(hold('bar'), hold('baz'),
+                return_exceptions=True)
+
+        self.assertEqual('bar', result[0])
+        self.assertIsInstance(result[1], TransactionManagementError)
+
+        # everything was cleaned up
+        async with Lock.alock('foo'):
+            self.assertEqual('bar', await hold('bar'))
+
     def test_choices(self):
         class Colours(Choices):
             RED = 'r'
@@ -45,6 +556,42 @@ class ModelsTest(TestCase):
         self.assertEqual('Red', Colours.get_value('r'))
         self.assertEqual('Red', MoreColours.get_value('r'))
 
+        # precomputed lookups, children's values show up in the parent
+        self.assertEqual(tuple(l), MoreColours.choices)
+        self.assertEqual(MoreColours.choices, Colours.choices)
+        self.assertIs(MoreColours.choices, MoreColours.choices)
+        self.assertEqual(4, len(Colours))
+        self.assertIn('g', Colours)
+        self.assertNotIn('x', MoreColours)
+        self.assertNotIn([], MoreColours)
+        self.assertTrue(MoreColours.is_valid('o'))
+        self.assertFalse(MoreColours.is_valid('Red'))
+
+        self.assertEqual('b', MoreColours.get_by_label('Blueish'))
+        self.assertEqual('o', Colours.get_by_label('Light Orange'))
+        self.assertEqual('g', MoreColours.get_by_name('GREEN'))
+        self.assertEqual('r', MoreColours.get_by_name('RED'))
+        with self.assertRaises(KeyError):
+            Colours.get_by_label('Green-ish')
+
+        with self.assertRaises(KeyError):
+            Colours.get_by_name('PURPLE')
+
+        # overriding a label in a grandchild rebuilds the lookups
+        class MostColours(MoreColours):
+            GREEN = ('g', 'Verdant')
+
+        self.assertEqual('g', Colours.get_by_label('Verdant'))
+        self.assertIn(('g', 'Verdant'), MoreColours.choices)
+        self.assertEqual(4, len(MostColours))
+
+        # separate families don't share anything
+        class Sizes(Choices):
+            SMALL = 's'
+
+        self.assertEqual((('s', 'Small'), ), Sizes.choices)
+        self.assertNotIn('s', Colours)
+
     def test_queryset_chain(self):
         # create some object to query
         from django.contrib.auth.models import User, Group
@@ -70,3 +617,635 @@ class ModelsTest(TestCase):
 
         # trigger internal _clone(), make sure it doesn't blow up
         chain._clone()
+
+    def test_queryset_chain_slicing(self):
+        from django.contrib.auth.models import User, Group
+        for name in ['u1', 'u2', 'u3']:
+            User.objects.create(username=name)
+
+        for name in ['g1', 'g2']:
+            Group.objects.create(name=name)
+
+        users = User.objects.order_by('username')
+        groups = Group.objects.order_by('name')
+        chain = QuerySetChain(users, groups)
+        everything = list(users.all()) + list(groups.all())
+
+        # first page only touches the first queryset
+        with self.assertNumQueries(1):
+            self.assertEqual(everything[0:2], chain[0:2])
+
+        # later page counts the skipped queryset and fetches from the next
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(everything[3:5], chain[3:5])
+
+        self.assertEqual(2, len(context.captured_queries))
+        self.assertIn('COUNT', context.captured_queries[0]['sql'])
+        self.assertIn('LIMIT 2', context.captured_queries[1]['sql'])
+
+        # slices spanning querysets, count is needed to see if the first
+        # one can be skipped
+        with self.assertNumQueries(3):
+            self.assertEqual(everything[1:4], chain._clone()[1:4])
+
+        self.assertEqual(everything[2:], chain[2:])
+        self.assertEqual(everything[::2], chain[::2])
+        self.assertEqual(everything[1:100], chain[1:100])
+        self.assertEqual([], chain[3:3])
+
+        with self.assertNumQueries(2):
+            self.assertEqual([], chain._clone()[5:])
+
+        # single items
+        self.assertEqual(everything[0], chain[0])
+        self.assertEqual(everything[4], chain[4])
+        with self.assertRaises(IndexError):
+            chain[5]
+
+        with self.assertRaises(ValueError):
+            chain[-1]
+
+    def test_queryset_chain_caching(self):
+        from django.contrib.auth.models import User, Group
+        from django.core.paginator import Paginator
+        for name in ['u1', 'u2', 'u3']:
+            User.objects.create(username=name)
+
+        for name in ['g1', 'g2']:
+            Group.objects.create(name=name)
+
+        users = User.objects.order_by('username')
+        groups = Group.objects.order_by('name')
+        empty = User.objects.none()
+        everything = list(users.all()) + list(groups.all())
+
+        # one count per queryset, no matter how often the paginator asks,
+        # empty querysets don't even need that
+        chain = QuerySetChain(users, empty, groups)
+        paginator = Paginator(chain, 2)
+        with self.assertNumQueries(4):
+            page = paginator.page(2)
+            self.assertEqual(everything[2:4], list(page))
+            self.assertEqual(5, chain.count())
+
+        with self.assertNumQueries(1):
+            self.assertEqual(everything[4:], list(paginator.page(3)))
+
+        # short reads give away the size of a queryset
+        chain = QuerySetChain(users, groups)
+        with self.assertNumQueries(2):
+            self.assertEqual(everything, chain[0:10])
+
+        with self.assertNumQueries(0):
+            self.assertEqual(5, chain.count())
+
+        # result cache is bounded and least recently used goes first
+        chain = QuerySetChain(users, groups, cache_size=2)
+        with self.assertNumQueries(1):
+            chain[0:2]
+            chain[0:2]
+
+        result = chain[1:3]
+        result.append('junk')
+        chain[0:2]
+        with self.assertNumQueries(0):
+            self.assertEqual(everything[1:3], chain[1:3])
+
+        chain[2:4]
+        with self.assertNumQueries(1):
+            chain[0:2]
+
+        # clones start from scratch
+        clone = chain._clone()
+        self.assertEqual(2, clone.cache_size)
+        with self.assertNumQueries(1):
+            clone[0:2]
+
+    def test_queryset_chain_ordering(self):
+        from tests.models import Author, Book
+        for name in ['a', 'c', 'e']:
+            Author.objects.create(name=name)
+
+        for name in ['b', 'd']:
+            Book.objects.create(name=name)
+
+        chain = QuerySetChain(Author.objects.all(), Book.objects.all())
+        ordered = chain.order_by('name')
+        self.assertEqual((), chain.ordering)
+        self.assertEqual(('name', ), ordered.ordering)
+
+        # each queryset is only asked for as many rows as the page needs
+        with CaptureQueriesContext(connection) as context:
+            result = ordered[0:2]
+
+        self.assertEqual(['a', 'b'], [item.name for item in result])
+        self.assertEqual(2, len(context.captured_queries))
+        for query in context.captured_queries:
+            self.assertIn('ORDER BY', query['sql'])
+            self.assertIn('LIMIT 2', query['sql'])
+
+        self.assertEqual(['c', 'd'], [item.name for item in ordered[2:4]])
+        self.assertEqual('e', ordered[4].name)
+        self.assertEqual(['a', 'b', 'c', 'd', 'e'],
+            [item.name for item in ordered._all()])
+        self.assertEqual(['a', 'b', 'c', 'd', 'e'],
+            [item.name for item in ordered._clone()[:]])
+        self.assertEqual(5, ordered.count())
+
+        # descending and mixed directions
+        self.assertEqual(['e', 'd', 'c'],
+            [item.name for item in chain.order_by('-name')[:3]])
+
+        Book.objects.create(name='a')
+        result = chain.order_by('name', '-id')[:3]
+        self.assertEqual([('a', Book), ('a', Author), ('b', Book)],
+            [(item.name, type(item)) for item in result])
+
+        # equal keys keep chain order
+        result = chain.order_by('name')[:2]
+        self.assertEqual([Author, Book], [type(item) for item in result])
+
+        # values() querysets
+        chain = QuerySetChain(Author.objects.values('name'),
+            Book.objects.values('name'))
+        self.assertEqual(['e', 'd', 'c'], [item['name'] for item in
+            chain.order_by('-name')[:3]])
+
+        with self.assertRaises(ValueError):
+            chain.order_by('?')
+
+    def test_queryset_chain_union(self):
+        from tests.models import Author, Book
+        for name in ['a', 'c', 'e']:
+            Author.objects.create(name=name)
+
+        for name in ['b', 'd']:
+            Book.objects.create(name=name)
+
+        # compatible values() querysets are a single UNION ALL query
+        chain = QuerySetChain(Author.objects.values('name'),
+            Book.objects.values('name'))
+        self.assertIsNotNone(chain._union)
+        with CaptureQueriesContext(connection) as context:
+            result = chain[1:4]
+            self.assertEqual(5, chain.count())
+
+        self.assertEqual([{'name':'c'}, {'name':'e'}, {'name':'b'}], result)
+        self.assertEqual(2, len(context.captured_queries))
+        for query in context.captured_queries:
+            self.assertIn('UNION ALL', query['sql'])
+
+        # ordering is done by the database
+        ordered = chain.order_by('-name')
+        self.assertIsNotNone(ordered._union)
+        with CaptureQueriesContext(connection) as context:
+            result = ordered[:3]
+
+        self.assertEqual(['e', 'd', 'c'], [item['name'] for item in result])
+        self.assertEqual(1, len(context.captured_queries))
+        self.assertEqual(['a', 'b', 'c', 'd', 'e'],
+            [item['name'] for item in chain.order_by('name')._all()])
+
+        # values_list() only needs the same number of columns
+        chain = QuerySetChain(Author.objects.values_list('name', 'id'),
+            Book.objects.values_list('name', 'id'))
+        self.assertIsNotNone(chain._union)
+        self.assertEqual(['a', 'c', 'e', 'b', 'd'],
+            [item[0] for item in chain[:]])
+
+        chain = QuerySetChain(Author.objects.values_list('name', flat=True),
+            Book.objects.values_list('name', flat=True))
+        self.assertEqual(['b', 'c'], chain.order_by('name')[1:3])
+
+        # anything else falls back to querying each subqueryset
+        chains = [
+            QuerySetChain(Author.objects.values('name')),
+            QuerySetChain(Author.objects.all(), Book.objects.all()),
+            QuerySetChain(Author.objects.values('name'),
+                Book.objects.values('id')),
+            QuerySetChain(Author.objects.values_list('name'),
+                Book.objects.values_list('name', 'id')),
+            QuerySetChain(Author.objects.values('name'),
+                Book.objects.values_list('name')),
+            QuerySetChain(Author.objects.values('name')[:2],
+                Book.objects.values('name')),
+            QuerySetChain(Author.objects.values('name').order_by('-name'),
+                Book.objects.values('name')),
+            QuerySetChain(Author.objects.values('name'),
+                Book.objects.values('name')).order_by('id'),
+        ]
+        for chain in chains:
+            self.assertIsNone(chain._union)
+
+        chain = chains[2]
+        self.assertEqual(5, chain.count())
+        self.assertEqual([{'name':'e'}, {'id':Book.objects.first().id}],
+            chain[2:4])
+
+        # mismatched column types, SQLite would accept the UNION but
+        # PostgreSQL doesn't
+        chain = QuerySetChain(Author.objects.values_list('id', 'name'),
+            Book.objects.values_list('name', 'id'))
+        self.assertIsNone(chain._union)
+        self.assertEqual([(Author.objects.last().id, 'e'), ('b',
+            Book.objects.first().id)], chain[2:4])
+
+        # foreign keys match the column they point at
+        chain = QuerySetChain(Author.objects.values_list('id', flat=True),
+            Book.objects.values_list('author', flat=True))
+        self.assertIsNotNone(chain._union)
+
+        chain = QuerySetChain(Author.objects.values_list('name', flat=True),
+            Book.objects.values_list('author', flat=True))
+        self.assertIsNone(chain._union)
+
+    def test_queryset_chain_cursor_page(self):
+        from tests.models import Author, Book
+        for name in ['a', 'c', 'e', 'a']:
+            Author.objects.create(name=name)
+
+        for name in ['b', 'a', 'd', 'c']:
+            Book.objects.create(name=name)
+
+        def walk(chain, size):
+            rows, cursor = chain.cursor_page(size)
+            pages = [rows]
+            while cursor:
+                # constant cost per page, one query per subqueryset
+                with CaptureQueriesContext(connection) as context:
+                    rows, cursor = chain.cursor_page(size, cursor)
+
+                self.assertEqual(2, len(context.captured_queries))
+                pages.append(rows)
+
+            return pages
+
+        chain = QuerySetChain(Author.objects.all(), Book.objects.all())
+        authors = list(Author.objects.order_by('id'))
+        books = list(Book.objects.order_by('id'))
+
+        # ties go by position in the chain then by pk
+        expected = [authors[0], authors[3], books[1], books[0], authors[1],
+            books[3], books[2], authors[2]]
+
+        pages = walk(chain.order_by('name'), 3)
+        self.assertEqual([3, 3, 2], [len(page) for page in pages])
+        self.assertEqual(expected, [row for page in pages for row in page])
+
+        pages = walk(chain.order_by('name'), 4)
+        self.assertEqual([4, 4], [len(page) for page in pages])
+
+        pages = walk(chain.order_by('-name'), 5)
+        self.assertEqual(['e', 'd', 'c', 'c', 'b', 'a', 'a', 'a'],
+            [row.name for page in pages for row in page])
+
+        # values() querysets with multiple fields
+        chain = QuerySetChain(Author.objects.values('pk', 'name'),
+            Book.objects.values('pk', 'name')).order_by('name', '-pk')
+        pages = walk(chain, 2)
+        self.assertEqual(['a', 'a', 'a', 'b', 'c', 'c', 'd', 'e'],
+            [row['name'] for page in pages for row in page])
+        self.assertEqual([authors[3].pk, books[1].pk],
+            [row['pk'] for row in pages[0]])
+
+        # errors
+        with self.assertRaises(ValueError):
+            QuerySetChain(Author.objects.all()).cursor_page(2)
+
+        chain = QuerySetChain(Author.objects.all()).order_by('name')
+        for cursor in ['bogus', 'W10=', 'WyJ4Il0=', 'W1siYSJdLCA1LCAxXQ==',
+                'W1tbIngiLCAiYSJdXSwgMCwgW251bGwsIDFdXQ==']:
+            with self.assertRaises(ValueError):
+                chain.cursor_page(2, cursor)
+
+    def test_queryset_chain_cursor_page_text(self):
+        from tests.models import Author, Book
+        for name in ['a', 'C', 'e']:
+            Author.objects.create(name=name)
+
+        for name in ['B', 'd']:
+            Book.objects.create(name=name)
+
+        # text keys sort by code point in the database, same as in Python
+        chain = QuerySetChain(Author.objects.all(),
+            Book.objects.values('pk', 'name')).order_by('name')
+        result = []
+        with CaptureQueriesContext(connection) as context:
+            rows, cursor = chain.cursor_page(1)
+            result.extend(rows)
+            while cursor:
+                rows, cursor = chain.cursor_page(1, cursor)
+                result.extend(rows)
+
+        self.assertEqual(['B', 'C', 'a', 'd', 'e'], [item['name']
+            if isinstance(item, dict) else item.name for item in result])
+        for query in context.captured_queries:
+            self.assertIn('COLLATE "BINARY"', query['sql'])
+
+        # numbers don't need a collation
+        chain = QuerySetChain(Author.objects.all()).order_by('-id')
+        with CaptureQueriesContext(connection) as context:
+            chain.cursor_page(1)
+
+        self.assertNotIn('COLLATE', context.captured_queries[0]['sql'])
+
+        with patch.object(connection, 'vendor', 'other'):
+            self.assertEqual(1, len(chain.cursor_page(1)[0]))
+            with self.assertRaises(ValueError):
+                chain.order_by('name').cursor_page(1)
+
+    def test_queryset_chain_cursor_page_precision(self):
+        # keys that only differ by microseconds survive the cursor
+        start = datetime(2026, 10, 18, 14, 5, 30, tzinfo=dt_timezone.utc)
+        for index in range(6):
+            counter = Counter.objects.create(name='c%d' % index)
+            Counter.objects.filter(id=counter.id).update(
+                created=start + timedelta(microseconds=2 * index))
+
+            lock = Lock.objects.create(name='l%d' % index)
+            Lock.objects.filter(id=lock.id).update(
+                created=start + timedelta(microseconds=2 * index + 1))
+
+        chain = QuerySetChain(Counter.objects.all(), Lock.objects.all())
+        expected = [item for index in range(6)
+            for item in ['c%d' % index, 'l%d' % index]]
+
+        for ordering, names in [('created', expected),
+                ('-created', expected[::-1])]:
+            ordered = chain.order_by(ordering)
+            result = []
+            rows, cursor = ordered.cursor_page(3)
+            result.extend(rows)
+            while cursor:
+                rows, cursor = ordered.cursor_page(3, cursor)
+                result.extend(rows)
+
+            self.assertEqual(names, [item.name for item in result])
+
+        # other types that JSON can't hold
+        for value in [date(2026, 10, 18), dt_time(14, 5, 30, 7),
+                timedelta(days=1, microseconds=3), Decimal('1.10'),
+                uuid.uuid4(), 'a', 3, 1.5, None]:
+            encoded = json.loads(json.dumps(_encode_cursor_value(value)))
+            self.assertEqual(value, _decode_cursor_value(encoded))
+
+        with self.assertRaises(ValueError):
+            _encode_cursor_value(object())
+
+    def test_queryset_chain_iterator(self):
+        from tests.models import Author, Book
+        for name in ['a', 'c', 'e']:
+            Author.objects.create(name=name)
+
+        for name in ['b', 'd']:
+            Book.objects.create(name=name)
+
+        authors = Author.objects.all()
+        books = Book.objects.all()
+        chain = QuerySetChain(authors, books, cache_size=2)
+
+        result = chain.iterator(chunk_size=2)
+        self.assertNotIsInstance(result, list)
+        self.assertEqual(['a', 'c', 'e', 'b', 'd'],
+            [item.name for item in result])
+
+        # nothing is cached anywhere
+        self.assertIsNone(authors._result_cache)
+        self.assertIsNone(books._result_cache)
+        self.assertEqual(0, len(chain._results))
+
+        ordered = chain.order_by('-name')
+        self.assertEqual(['e', 'd', 'c', 'b', 'a'],
+            [item.name for item in ordered.iterator()])
+        for qs in ordered.querysets:
+            self.assertIsNone(qs._result_cache)
+
+        # UNION ALL chains stream the combined query
+        chain = QuerySetChain(Author.objects.values_list('name', flat=True),
+            Book.objects.values_list('name', flat=True)).order_by('name')
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(['a', 'b', 'c', 'd', 'e'],
+                list(chain.iterator()))
+
+        self.assertEqual(1, len(context.captured_queries))
+
+    async def test_queryset_chain_async(self):
+        from tests.models import Author, Book
+        for name in ['a', 'c', 'e']:
+            await Author.objects.acreate(name=name)
+
+        for name in ['b', 'd']:
+            await Book.objects.acreate(name=name)
+
+        chain = QuerySetChain(Author.objects.all(), Book.objects.all())
+        self.assertEqual(5, await chain.acount())
+        self.assertEqual([3, 2], chain._counts)
+        self.assertEqual([0, 3, 5], chain._offsets)
+
+        # partly counted chains only count what is missing
+        chain = chain._clone()
+        chain._counts[0] = 10
+        self.assertEqual(12, await chain.acount())
+
+        chain = chain._clone()
+
+        self.assertEqual(['a', 'c', 'e', 'b', 'd'],
+            [item.name async for item in chain])
+        self.assertEqual(['e', 'd', 'c', 'b', 'a'],
+            [item.name async for item in
+                chain.order_by('-name').aiterator(chunk_size=2)])
+
+        result = await chain.agetitem(slice(2, 4))
+        self.assertEqual(['e', 'b'], [item.name for item in result])
+        self.assertEqual('d', (await chain.agetitem(4)).name)
+        with self.assertRaises(IndexError):
+            await chain.agetitem(5)
+
+        # UNION ALL chains
+        chain = QuerySetChain(Author.objects.values_list('name', flat=True),
+            Book.objects.values_list('name', flat=True)).order_by('name')
+        self.assertEqual(5, await chain.acount())
+        self.assertEqual(['a', 'b', 'c', 'd', 'e'],
+            [name async for name in chain])
+
+
+class QuerySetChainCountTest(TransactionTestCase):
+    async def test_acount(self):
+        from tests.models import Author, Book
+        for name in ['a', 'c', 'e']:
+            await Author.objects.acreate(name=name)
+
+        for name in ['b', 'd']:
+            await Book.objects.acreate(name=name)
+
+        await Counter.objects.acreate(name='x')
+
+        # each count runs in its own thread at the same time
+        original = QuerySet.count
+        threads = set()
+
+        def slow_count(qs):
+            threads.add(threading.get_ident())
+            time.sleep(0.2)
+            return original(qs)
+
+        chain = QuerySetChain(Author.objects.all(), Book.objects.all(),
+            Counter.objects.all())
+        with patch.object(QuerySet, 'count', slow_count):
+            started = time.monotonic()
+            self.assertEqual(6, await chain.acount(concurrent=True))
+            elapsed = time.monotonic() - started
+
+        self.assertEqual([3, 2, 1], chain._counts)
+        self.assertEqual(3, len(threads))
+        self.assertLess(elapsed, 0.5)
+
+        threads.clear()
+        chain = chain._clone()
+        with patch.object(QuerySet, 'count', slow_count):
+            self.assertEqual(6, await chain.acount())
+
+        self.assertEqual(1, len(threads))
+
+
+class LeaseHeartbeatTest(TransactionTestCase):
+    def test_heartbeat(self):
+        with Lock.lease('foo', ttl=60, heartbeat=0.01) as lease:
+            expires = Lock.objects.get(name='foo').expires
+            time.sleep(0.1)
+
+            # background thread has pushed the expiry out
+            self.assertGreater(Lock.objects.get(name='foo').expires, expires)
+            self.assertFalse(lease.lost)
+
+        self.assertIsNone(Lock.objects.get(name='foo').expires)
+
+        # thread stops when the lease is lost
+        with Lock.lease('foo', ttl=60, heartbeat=0.01) as lease:
+            Lock.objects.filter(name='foo').update(owner='other')
+            lease._thread.join()
+            self.assertTrue(lease.lost)
+
+    def test_heartbeat_errors(self):
+        renew_lease = Lock.renew_lease
+        calls = []
+
+        def flaky(*args, **kwargs):
+            calls.append(args)
+            if len(calls) == 1:
+                raise OperationalError('server closed the connection')
+
+            return renew_lease(*args, **kwargs)
+
+        # a failure is logged and retried
+        with self.assertLogs('awl.models', 'ERROR'):
+            with patch.object(Lock, 'renew_lease', side_effect=flaky):
+                with Lock.lease('foo', ttl=60, heartbeat=0.01) as lease:
+                    while len(calls) < 3:
+                        time.sleep(0.01)
+
+                    self.assertFalse(lease.lost)
+                    self.assertTrue(lease._thread.is_alive())
+
+        # the lease is lost once it expires without a renewal
+        failing = patch.object(Lock, 'renew_lease',
+            side_effect=OperationalError('server closed the connection'))
+        with self.assertLogs('awl.models', 'ERROR'), failing:
+            with Lock.lease('foo', ttl=0.1, heartbeat=0.02) as lease:
+                lease._thread.join(5)
+                self.assertFalse(lease._thread.is_alive())
+                self.assertTrue(lease.lost)
+                self.assertGreaterEqual(time.monotonic(), lease._expires)
+
+
+class SecondRouter:
+    # sends everything in the awl app to the "second" database
+    def db_for_write(self, model, **hints):
+        if model._meta.app_label == 'awl':
+            return 'second'
+
+        return None
+
+
+class UsingTest(TestCase):
+    databases = {'default', 'second'}
+
+    def assertIn2nd(self, model, name):
+        self.assertTrue(model.objects.using('second').filter(
+            name=name).exists())
+        self.assertFalse(model.objects.filter(name=name).exists())
+
+    def test_counter(self):
+        self.assertEqual(1, Counter.increment('a', using='second'))
+        self.assertEqual(3, Counter.increment('a', 2, using='second'))
+        self.assertIn2nd(Counter, 'a')
+        self.assertEqual(3, Counter.get_value('a', using='second'))
+        with self.assertRaises(Counter.DoesNotExist):
+            Counter.get_value('a')
+
+        self.assertEqual({'a':4, 'b':1}, Counter.increment_many({'a':1,
+            'b':1}, using='second'))
+        self.assertIn2nd(Counter, 'b')
+
+        self.assertEqual(range(1, 11), Counter.reserve('c', 10,
+            using='second'))
+        self.assertIn2nd(Counter, 'c')
+
+        Counter.set_shards('d', 2, using='second')
+        self.assertEqual(2, CounterShard.objects.using('second').count())
+        self.assertEqual(5, Counter.increment('d', 5, using='second'))
+        self.assertEqual({'d':6}, Counter.increment_many({'d':1},
+            using='second'))
+        self.assertEqual(0, CounterShard.objects.count())
+        self.assertIn2nd(Counter, 'd')
+
+        # setting and router fallbacks
+        with override_settings(AWL_DATABASE='second'):
+            Counter.increment('e')
+
+        self.assertIn2nd(Counter, 'e')
+
+        with override_settings(DATABASE_ROUTERS=[
+                'tests.test_models.SecondRouter']):
+            Counter.increment('f')
+            self.assertEqual(1, Counter.get_value('f'))
+
+        self.assertIn2nd(Counter, 'f')
+
+    async def test_counter_async(self):
+        self.assertEqual(2, await Counter.aincrement('a', 2, using='second'))
+        self.assertEqual({'a':2}, await Counter.aget_values(['a'],
+            using='second'))
+        self.assertFalse(await Counter.objects.filter(name='a').aexists())
+
+    def test_lock(self):
+        with transaction.atomic(using='second'):
+            self.assertTrue(Lock.lock_until_commit('a', using='second'))
+            self.assertTrue(Lock.lock_until_commit('b', nowait=True,
+                using='second'))
+            self.assertEqual(['c', 'd'], Lock.lock_many(['c', 'd'],
+                using='second'))
+
+            # held in the second database's transaction only
+            second = transaction.get_connection('second')
+            self.assertTrue(Lock._is_held(second, 'a', False))
+            self.assertFalse(Lock._is_held(connection, 'a', False))
+
+        for name in 'abcd':
+            self.assertIn2nd(Lock, name)
+
+        with Lock.lease('e', heartbeat=0, using='second') as lease:
+            self.assertEqual(lease.owner, Lock.objects.using('second').get(
+                name='e').owner)
+            self.assertTrue(lease.renew())
+
+        self.assertIn2nd(Lock, 'e')
+        self.assertEqual('', Lock.objects.using('second').get(
+            name='e').owner)
+
+    async def test_lock_async(self):
+        async with Lock.alock('a', using='second') as acquired:
+            self.assertTrue(acquired)
+
+        self.assertTrue(await Lock.objects.using('second').filter(
+            name='a').aexists())
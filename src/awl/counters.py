@@ -0,0 +1,522 @@
+# awl.counters.py
+import atexit
+import logging
+import threading
+import time
+
+from django.core.cache import caches
+from django.core.signals import request_finished
+from django.db import close_old_connections, connections
+from django.db.models import F
+from django.utils import timezone
+
+from awl.models import Counter, _db_alias
+
+logger = logging.getLogger(__name__)
+
+# ============================================================================
+# Write-Behind Buffering
+# ============================================================================
+
+class CounterBuffer:
+    """In-process accumulator that sits in front of :class:`Counter`.
+    Increments are summed in memory per counter name and written to the
+    database in a single batched ``UPDATE`` when the buffer is flushed (see
+    :meth:`Counter.add_many`).
+    Meant for metrics-style counters where losing a few ticks on a crash is
+    acceptable in exchange for far fewer SQL statements.
+
+    .. code-block:: python
+
+        # module level, one per process
+        hits = CounterBuffer(max_delay=10, max_pending=500)
+
+        # views.py
+        def something(request):
+            hits.increment('something-views')
+
+    The buffer is flushed when:
+
+    * the oldest unwritten increment is ``max_delay`` seconds old, either by
+      a background thread or by the next increment to arrive
+    * more than ``max_pending`` increments are waiting
+    * a request finishes (if ``flush_on_request_end`` is set, which costs
+      at least one ``UPDATE`` per request that incremented anything, as much
+      as not buffering)
+    * the process exits normally
+    * :meth:`CounterBuffer.flush` is called
+
+    With ``flush_in_background`` set, a daemon thread is started with the
+    first increment and flushes the buffer once its oldest increment has
+    waited ``max_delay`` seconds, even if no more increments arrive.  The
+    thread uses its own database connection.  Together ``max_delay`` and
+    ``max_pending`` then bound how long a value sits in memory and how many
+    increments can be lost if the process dies.  Without the thread a value
+    can sit in the buffer until the next increment, request end or exit.
+    Failed background flushes are logged and retried after another
+    ``max_delay`` seconds.
+
+    :param max_delay:
+        Maximum number of seconds an increment can wait before a flush is
+        triggered.  Defaults to 5.
+    :param max_pending:
+        Maximum number of increments to hold before a flush is triggered.
+        Defaults to 1000.
+    :param flush_on_request_end:
+        Flush whenever Django finishes serving a request.  Defaults to False.
+    :param flush_in_background:
+        Flush from a background thread when ``max_delay`` has passed.
+        Defaults to True.
+    :param using:
+        Alias of the database the counters are in.  Defaults to None, see
+        :ref:`counter-lock-database`.
+    """
+    def __init__(self, max_delay=5, max_pending=1000,
+            flush_on_request_end=False, flush_in_background=True,
+            using=None):
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self.flush_in_background = flush_in_background
+        self.using = using
+
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._num_pending = 0
+        self._oldest = None
+
+        # background flushing, "_wake" is set when the oldest increment
+        # changes or the buffer is closed
+        self._wake = threading.Event()
+        self._closed = False
+        self._thread = None
+
+        self.flush_on_request_end = flush_on_request_end
+        if flush_on_request_end:
+            request_finished.connect(self._request_finished)
+
+        atexit.register(self.flush)
+
+    def _request_finished(self, sender, **kwargs):
+        self.flush()
+
+    def increment(self, name, delta=1):
+        """Adds ``delta`` to the named counter's pending total, flushing if
+        one of the thresholds has been passed.
+
+        :param name:
+            Name of the counter
+        :param delta:
+            Amount to change the counter by, can be negative.  Defaults to 1.
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._pending[name] = self._pending.get(name, 0) + delta
+            self._num_pending += 1
+            if self._oldest is None:
+                self._oldest = now
+                self._start_timer()
+
+            due = self._num_pending >= self.max_pending or \
+                now - self._oldest >= self.max_delay
+
+        if due:
+            self.flush()
+
+    def _start_timer(self):
+        # called holding the lock when the buffer goes from empty to having
+        # something in it, starts or wakes up the background thread
+        if not self.flush_in_background or self._closed:
+            return
+
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+        self._wake.set()
+
+    def _run(self):
+        # runs in its own thread and so uses its own database connection,
+        # which is closed when done
+        try:
+            while True:
+                with self._lock:
+                    if self._closed:
+                        break
+
+                    self._wake.clear()
+                    timeout = None
+                    if self._oldest is not None:
+                        timeout = max(0, self._oldest + self.max_delay -
+                            time.monotonic())
+
+                if self._wake.wait(timeout):
+                    # new oldest increment or closing, work out what to do
+                    continue
+
+                with self._lock:
+                    due = self._oldest is not None and time.monotonic() - \
+                        self._oldest >= self.max_delay
+
+                if due:
+                    # drop a connection the database has closed since the
+                    # last flush, instead of failing on it forever
+                    close_old_connections()
+                    try:
+                        self.flush()
+                    except Exception:
+                        logger.exception('Background flush of counters '
+                            'failed')
+        finally:
+            connections.close_all()
+
+    def pending(self, name):
+        """Returns the amount not yet written to the database for the named
+        counter."""
+        with self._lock:
+            return self._pending.get(name, 0)
+
+    def flush(self):
+        """Writes all pending increments to the database using
+        :meth:`Counter.add_many`, a single ``UPDATE`` when all the counters
+        already exist and aren't sharded.  If the write fails the increments
+        that weren't written are put back into the buffer."""
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+            self._num_pending = 0
+            self._oldest = None
+
+        # zero sum changes don't need to be written
+        pending = {name:delta for name, delta in pending.items() if delta}
+        if not pending:
+            return
+
+        written = set()
+        try:
+            Counter.add_many(pending, using=self.using, written=written)
+        except Exception:
+            self._restore({name:delta for name, delta in pending.items()
+                if name not in written})
+            raise
+
+    def _restore(self, deltas):
+        # puts unwritten deltas back so they can be retried on the next flush
+        with self._lock:
+            for name, delta in deltas.items():
+                self._pending[name] = self._pending.get(name, 0) + delta
+                self._num_pending += 1
+
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+                self._start_timer()
+
+    def close(self):
+        """Flushes any pending increments, stops the background thread and
+        disconnects the buffer from the request and exit hooks."""
+        if self.flush_on_request_end:
+            request_finished.disconnect(self._request_finished)
+
+        atexit.unregister(self.flush)
+        with self._lock:
+            self._closed = True
+            self._wake.set()
+
+        if self._thread is not None:
+            self._thread.join()
+
+        self.flush()
+
+# ============================================================================
+# Block Allocation
+# ============================================================================
+
+class BlockAllocator:
+    """Hands out sequence style numbers from a :class:`Counter` using hi/lo
+    allocation: a block of ``block_size`` values is reserved with a single
+    ``UPDATE`` (see :meth:`Counter.reserve`) and then served from memory.
+    Safe to share between threads.
+
+    .. code-block:: python
+
+        invoices = BlockAllocator('invoice', block_size=50)
+
+        def create_invoice():
+            number = invoices.next_value()
+
+    Each process reserves its own blocks, so values are unique but are not
+    handed out in strictly increasing order across processes.
+
+    :param name:
+        Name of an un-sharded counter
+    :param block_size:
+        Number of values to reserve at a time, at least 1.  Defaults to 100.
+    :param allow_gaps:
+        When False, any values left in the pool are given back to the counter
+        when :meth:`BlockAllocator.release` is called, which also happens at
+        process exit.  This only succeeds if no other allocator has reserved
+        a block since, and values are always lost if the process dies.
+        Defaults to True, meaning unused values are simply skipped.
+    :param using:
+        Alias of the database the counter is in.  Defaults to None, see
+        :ref:`counter-lock-database`.
+    """
+    def __init__(self, name, block_size=100, allow_gaps=True, using=None):
+        if block_size < 1:
+            raise ValueError('block_size must be at least 1, not %s' % (
+                block_size))
+
+        self.name = name
+        self.block_size = block_size
+        self.allow_gaps = allow_gaps
+        self.using = using
+
+        self._lock = threading.Lock()
+        self._block = range(0)
+        self._position = 0
+
+        if not allow_gaps:
+            atexit.register(self.release)
+
+    def next_value(self):
+        """Returns the next value from the pool, reserving a new block from
+        the database if the pool is empty."""
+        with self._lock:
+            if self._position >= len(self._block):
+                self._block = Counter.reserve(self.name, self.block_size,
+                    using=self.using)
+                self._position = 0
+
+            value = self._block[self._position]
+            self._position += 1
+            return value
+
+    def release(self):
+        """Tries to give the unused values in the pool back to the counter.
+        This is only possible if the counter hasn't moved since the block was
+        reserved.
+
+        :returns:
+            True if there was nothing to give back or the values were
+            returned, False if they could not be and there will be a gap
+        """
+        with self._lock:
+            unused = len(self._block) - self._position
+            if not unused:
+                return True
+
+            last = self._block[-1]
+            counters = Counter.objects.using(_db_alias(Counter, self.using))
+            returned = counters.filter(name=self.name, num_shards=0,
+                value=last).update(value=F('value') - unused,
+                updated=timezone.now())
+
+            self._block = range(0)
+            self._position = 0
+            return bool(returned)
+
+# ============================================================================
+# Cache Backed Counting
+# ============================================================================
+
+class CacheCounter:
+    """Counts using the atomic ``incr`` of Django's cache framework instead
+    of the database, with :class:`Counter` rows kept as the durable record.
+    Increments are added to a "pending" key in the cache, and
+    :meth:`CacheCounter.reconcile` moves the pending amounts into the
+    database, either on demand, every ``reconcile_interval`` seconds, or
+    from the ``reconcile_counters`` management command.
+
+    .. code-block:: python
+
+        views = CacheCounter(reconcile_interval=60)
+
+        def something(request):
+            views.increment('something-views')
+
+    Reads add the pending amount to the last known database value, which is
+    also cached and falls back to the database when it is missing.
+    Increases and decreases are kept in separate keys, as memcached can't
+    store negative numbers, so negative deltas are safe on every backend.
+
+    The names of counters are also recorded in the cache when they are first
+    incremented, so a reconcile of all counters writes ones that don't have
+    a database row yet.
+
+    Increments are only as atomic as the cache backend's ``incr``: memcached
+    and redis are atomic across processes, the local-memory cache only
+    within a process, and the file based cache not at all.  Any of them work
+    as a stand-in for development.
+
+    :param cache_alias:
+        Name of the cache in the ``CACHES`` setting to use.  Defaults to
+        "default".
+    :param prefix:
+        Prefix for the cache keys.  Defaults to "awl-counter".
+    :param timeout:
+        How long in seconds the cached database values are kept before being
+        re-read, pending amounts never expire.  Defaults to 300.
+    :param reconcile_interval:
+        If set, a reconcile of the counters used by this object is done
+        during an increment when more than this many seconds have passed
+        since the last one.  Defaults to None.
+    :param using:
+        Alias of the database the counters are in.  Defaults to None, see
+        :ref:`counter-lock-database`.
+    """
+    def __init__(self, cache_alias='default', prefix='awl-counter',
+            timeout=300, reconcile_interval=None, using=None):
+        self.cache = caches[cache_alias]
+        self.prefix = prefix
+        self.timeout = timeout
+        self.reconcile_interval = reconcile_interval
+        self.using = using
+
+        self._lock = threading.Lock()
+        self._names = set()
+        self._last_reconcile = time.monotonic()
+
+    def _pending_key(self, name, negative=False):
+        # increases and decreases are kept in separate keys that only ever go
+        # up, memcached can't hold negative numbers and its decr stops at 0
+        kind = 'pending-negative' if negative else 'pending'
+        return '%s:%s:%s' % (self.prefix, kind, name)
+
+    def _value_key(self, name):
+        return '%s:value:%s' % (self.prefix, name)
+
+    def _names_key(self, slot):
+        return '%s:names:%s' % (self.prefix, slot)
+
+    def _register(self, name):
+        # records a new counter name in the cache so reconcile() can find
+        # counters that don't have a database row yet; each name gets its own
+        # slot numbered by an atomic incr, so concurrent registrations from
+        # different processes don't overwrite each other
+        key = self._names_key('count')
+        self.cache.add(key, 0, timeout=None)
+        slot = self.cache.incr(key)
+        self.cache.set(self._names_key(slot), name, timeout=None)
+
+    def _registered_names(self):
+        count = self.cache.get(self._names_key('count'), 0)
+        found = self.cache.get_many([self._names_key(slot)
+            for slot in range(1, count + 1)])
+        return set(found.values())
+
+    def increment(self, name, delta=1):
+        """Adds ``delta`` to the named counter in the cache.
+
+        :param name:
+            Name of the counter
+        :param delta:
+            Amount to change the counter by, can be negative.  Defaults to 1.
+        :returns:
+            The new value of the counter
+        """
+        negative = delta < 0
+        key = self._pending_key(name, negative)
+        try:
+            amount = self.cache.incr(key, abs(delta))
+        except ValueError:
+            # key isn't there yet, add() won't clobber a concurrent creator
+            if self.cache.add(key, 0, timeout=None):
+                self._register(name)
+
+            amount = self.cache.incr(key, abs(delta))
+
+        other = self.cache.get(self._pending_key(name, not negative), 0)
+        pending = other - amount if negative else amount - other
+
+        with self._lock:
+            self._names.add(name)
+            due = self.reconcile_interval is not None and \
+                time.monotonic() - self._last_reconcile >= \
+                self.reconcile_interval
+
+        if due:
+            self.reconcile(list(self._names))
+            return self.get_value(name)
+
+        return self._stored_value(name) + pending
+
+    def _stored_value(self, name):
+        # last known database value, from the cache if it is warm
+        key = self._value_key(name)
+        value = self.cache.get(key)
+        if value is None:
+            value = Counter.get_values([name], using=self.using).get(name, 0)
+            self.cache.add(key, value, timeout=self.timeout)
+
+        return value
+
+    def get_value(self, name):
+        """Returns the value of the named counter, including any amount not
+        yet written to the database.
+
+        :param name:
+            Name of the counter
+        """
+        return self._stored_value(name) + self._pending(name)
+
+    def _pending(self, name):
+        # amount not yet written to the database
+        up = self._pending_key(name)
+        down = self._pending_key(name, True)
+        found = self.cache.get_many([up, down])
+        return found.get(up, 0) - found.get(down, 0)
+
+    def reconcile(self, names=None):
+        """Moves the pending amounts for the given counters out of the cache
+        and into the database in a single transaction, see
+        :meth:`Counter.increment_many`.  Pending amounts are taken with an
+        atomic decrement so increments that happen during the reconcile are
+        not lost.  If the database write fails the amounts are put back.
+
+        :param names:
+            Names of the counters to reconcile.  Defaults to None, meaning
+            every counter incremented through the cache with this prefix as
+            well as all ``Counter`` objects in the database.
+        :returns:
+            Dictionary mapping counter names to the amounts written
+        """
+        with self._lock:
+            self._last_reconcile = time.monotonic()
+
+        if names is None:
+            counters = Counter.objects.using(_db_alias(Counter, self.using))
+            names = self._registered_names()
+            names.update(counters.values_list('name', flat=True))
+
+        keys = {}
+        for name in names:
+            keys[self._pending_key(name)] = (name, 1)
+            keys[self._pending_key(name, True)] = (name, -1)
+
+        found = self.cache.get_many(keys.keys())
+
+        # the keys only grow between reading and decrementing them, so
+        # taking what was read never goes below zero
+        removed = {}
+        taken = {}
+        for key, amount in found.items():
+            if amount:
+                self.cache.decr(key, amount)
+                removed[key] = amount
+                name, sign = keys[key]
+                taken[name] = taken.get(name, 0) + sign * amount
+
+        taken = {name:delta for name, delta in taken.items() if delta}
+        if not taken:
+            return taken
+
+        try:
+            values = Counter.increment_many(taken, using=self.using)
+        except Exception:
+            for key, amount in removed.items():
+                self.cache.incr(key, amount)
+
+            raise
+
+        self.cache.set_many({self._value_key(name):value
+            for name, value in values.items()}, timeout=self.timeout)
+        return taken
@@ -0,0 +1,201 @@
+# awl.lockstats.py
+import threading
+import time
+from functools import partial
+
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.db import transaction
+from django.http import HttpResponse, JsonResponse
+
+# ============================================================================
+# Stats Registry
+# ============================================================================
+
+class _Entry:
+    # accumulated numbers for a single lock or counter name
+    def __init__(self, num_buckets):
+        self.acquires = 0
+        self.contended = 0
+        self.failed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.wait_histogram = [0] * num_buckets
+        self.holds = 0
+        self.hold_total = 0.0
+        self.hold_max = 0.0
+        self.hold_histogram = [0] * num_buckets
+
+
+class LockStats:
+    """In-process registry of how long :class:`awl.models.Lock` and
+    :class:`awl.models.Counter` calls wait to get their row locks, and how
+    long they hold them.  Numbers are kept per kind ("lock" or "counter")
+    and name.
+
+    Recording is off unless the ``AWL_LOCK_STATS`` setting is True.  Each
+    process keeps its own numbers, use :func:`lock_stats_view` to see them
+    from a running server.
+
+    Wait time is measured from the start of the call until the lock is
+    granted.  Hold time runs from then until the transaction commits, using
+    ``transaction.on_commit()``, so holds ended by a rollback aren't
+    counted.  An acquire counts as contended if it waited longer than
+    ``contended_after`` seconds or failed.
+
+    Histograms count how many waits or holds were less than or equal to
+    each of the bounds in ``BUCKETS`` (in seconds), with a final slot for
+    anything longer.
+    """
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+    def __init__(self, contended_after=0.001):
+        self.contended_after = contended_after
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    @property
+    def enabled(self):
+        return getattr(settings, 'AWL_LOCK_STATS', False)
+
+    def _bucket(self, seconds):
+        for index, bound in enumerate(self.BUCKETS):
+            if seconds <= bound:
+                return index
+
+        return len(self.BUCKETS)
+
+    def _entry(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = _Entry(len(self.BUCKETS) + 1)
+            self._entries[key] = entry
+
+        return entry
+
+    def record(self, kind, names, started, acquired=True, using=None):
+        """Records one acquire attempt, does nothing if stats are turned off.
+
+        :param kind:
+            Type of thing being locked, "lock" or "counter"
+        :param names:
+            Name, or list of names acquired together
+        :param started:
+            ``time.monotonic()`` value from the start of the attempt
+        :param acquired:
+            False if the attempt failed or gave up.  Defaults to True.
+        :param using:
+            Database alias of the transaction holding the lock.  Defaults to
+            None, meaning the default database.
+        """
+        if not self.enabled:
+            return
+
+        if isinstance(names, str):
+            names = [names]
+
+        now = time.monotonic()
+        wait = now - started
+        bucket = self._bucket(wait)
+        keys = [(kind, name) for name in names]
+
+        with self._lock:
+            for key in keys:
+                entry = self._entry(key)
+                entry.acquires += 1
+                entry.wait_total += wait
+                entry.wait_max = max(entry.wait_max, wait)
+                entry.wait_histogram[bucket] += 1
+                if not acquired:
+                    entry.failed += 1
+
+                if not acquired or wait > self.contended_after:
+                    entry.contended += 1
+
+        if acquired:
+            transaction.on_commit(partial(self._released, keys, now),
+                using=using)
+
+    def _released(self, keys, acquired):
+        hold = time.monotonic() - acquired
+        bucket = self._bucket(hold)
+        with self._lock:
+            for key in keys:
+                entry = self._entry(key)
+                entry.holds += 1
+                entry.hold_total += hold
+                entry.hold_max = max(entry.hold_max, hold)
+                entry.hold_histogram[bucket] += 1
+
+    def snapshot(self):
+        """Returns a list of dictionaries, one per lock or counter name,
+        sorted with the longest total wait first."""
+        with self._lock:
+            result = [{
+                'kind':kind,
+                'name':name,
+                'acquires':entry.acquires,
+                'contended':entry.contended,
+                'failed':entry.failed,
+                'wait_total':entry.wait_total,
+                'wait_max':entry.wait_max,
+                'wait_histogram':list(entry.wait_histogram),
+                'holds':entry.holds,
+                'hold_total':entry.hold_total,
+                'hold_max':entry.hold_max,
+                'hold_histogram':list(entry.hold_histogram),
+            } for (kind, name), entry in self._entries.items()]
+
+        result.sort(key=lambda item: item['wait_total'], reverse=True)
+        return result
+
+    def as_text(self):
+        """Returns the snapshot as a plain text table."""
+        lines = ['%-8s %-30s %8s %9s %6s %10s %10s %10s %10s' % ('kind',
+            'name', 'acquires', 'contended', 'failed', 'wait avg', 'wait max',
+            'hold avg', 'hold max')]
+        for item in self.snapshot():
+            wait_avg = item['wait_total'] / item['acquires']
+            hold_avg = item['hold_total'] / item['holds'] if item['holds'] \
+                else 0
+            lines.append('%-8s %-30s %8d %9d %6d %10.4f %10.4f %10.4f %10.4f'
+                % (item['kind'], item['name'], item['acquires'],
+                item['contended'], item['failed'], wait_avg, item['wait_max'],
+                hold_avg, item['hold_max']))
+
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        """Throws away everything recorded so far."""
+        with self._lock:
+            self._entries = {}
+
+
+#: Registry used by :class:`awl.models.Lock` and :class:`awl.models.Counter`
+lock_stats = LockStats()
+
+# ============================================================================
+# Views
+# ============================================================================
+
+@staff_member_required
+def lock_stats_view(request):
+    """Staff only view that dumps this process's :data:`lock_stats` as JSON,
+    or as a plain text table when called with ``?format=text``.
+
+    .. code-block:: python
+
+        # urls.py
+        from awl.lockstats import lock_stats_view
+
+        urlpatterns = [
+            path('lock_stats/', lock_stats_view),
+        ]
+    """
+    if request.GET.get('format') == 'text':
+        return HttpResponse(lock_stats.as_text(), content_type='text/plain')
+
+    return JsonResponse({
+        'buckets':LockStats.BUCKETS,
+        'stats':lock_stats.snapshot(),
+    })
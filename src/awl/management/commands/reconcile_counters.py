@@ -0,0 +1,35 @@
+# awl.management.commands.reconcile_counters.py
+#
+# Writes counter increments held in the cache by awl.counters.CacheCounter
+# into the database, meant to be run periodically from cron or similar
+
+from django.core.management.base import BaseCommand
+
+from awl.counters import CacheCounter
+
+class Command(BaseCommand):
+    """Moves the pending counter amounts stored in the cache by
+    :class:`awl.counters.CacheCounter` into the corresponding
+    :class:`awl.models.Counter` rows.  Meant to be run periodically."""
+
+    def __init__(self, *args, **kwargs):
+        super(Command, self).__init__(*args, **kwargs)
+        self.help = self.__doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument('names', type=str, nargs='*',
+            help=('names of the counters to reconcile, defaults to all '
+                'counters'))
+        parser.add_argument('--cache', type=str, default='default',
+            help='name of the cache the counters are stored in')
+        parser.add_argument('--prefix', type=str, default='awl-counter',
+            help='prefix used for the cache keys')
+        parser.add_argument('--database', type=str, default=None,
+            help='database the counters are stored in')
+
+    def handle(self, *args, **options):
+        counter = CacheCounter(options['cache'], options['prefix'],
+            using=options['database'])
+        taken = counter.reconcile(options['names'] or None)
+        for name, amount in sorted(taken.items()):
+            print('%s %+d' % (name, amount))
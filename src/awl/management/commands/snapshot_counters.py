@@ -0,0 +1,46 @@
+# awl.management.commands.snapshot_counters.py
+#
+# Records the current values of awl.models.Counter objects as
+# awl.models.CounterSnapshot rows, meant to be run periodically from cron or
+# similar
+
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from awl.models import CounterSnapshot
+
+class Command(BaseCommand):
+    """Records the current values of :class:`awl.models.Counter` objects as
+    :class:`awl.models.CounterSnapshot` rows.  Meant to be run
+    periodically."""
+
+    def __init__(self, *args, **kwargs):
+        super(Command, self).__init__(*args, **kwargs)
+        self.help = self.__doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument('names', type=str, nargs='*',
+            help=('names of the counters to record, defaults to all '
+                'counters'))
+        parser.add_argument('--interval', type=int, default=0,
+            help=('only take a snapshot if the last one is at least this '
+                'many seconds old'))
+        parser.add_argument('--keep', type=int, default=None,
+            help='delete snapshots older than this many days')
+        parser.add_argument('--database', type=str, default=None,
+            help='database the counters are stored in')
+
+    def handle(self, *args, **options):
+        names = options['names'] or None
+        using = options['database']
+
+        taken = CounterSnapshot.maybe_take(options['interval'], names,
+            using=using)
+        print('took %d snapshots' % taken)
+
+        if options['keep'] is not None:
+            before = timezone.now() - timedelta(days=options['keep'])
+            pruned = CounterSnapshot.prune(before, using=using)
+            print('pruned %d snapshots' % pruned)
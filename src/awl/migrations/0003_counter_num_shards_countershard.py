@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:11
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('awl', '0002_alter_counter_id_alter_lock_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='counter',
+            name='num_shards',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='CounterShard',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.PositiveSmallIntegerField()),
+                ('value', models.BigIntegerField(default=0)),
+                ('counter', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='shards', to='awl.counter')),
+            ],
+            options={
+                'unique_together': {('counter', 'index')},
+            },
+        ),
+    ]
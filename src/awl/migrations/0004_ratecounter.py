@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('awl', '0003_counter_num_shards_countershard'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RateCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=30)),
+                ('resolution', models.PositiveIntegerField()),
+                ('start', models.DateTimeField()),
+                ('value', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'unique_together': {('name', 'resolution', 'start')},
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('awl', '0004_ratecounter'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='counter',
+            name='name',
+            field=models.CharField(max_length=30, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='lock',
+            name='name',
+            field=models.CharField(max_length=30, unique=True),
+        ),
+    ]
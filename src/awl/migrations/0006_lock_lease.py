@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('awl', '0005_unique_names'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='lock',
+            name='expires',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='lock',
+            name='owner',
+            field=models.CharField(blank=True, default='', max_length=32),
+        ),
+    ]
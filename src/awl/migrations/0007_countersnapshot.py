@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('awl', '0006_lock_lease'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CounterSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=30)),
+                ('value', models.BigIntegerField()),
+                ('taken', models.DateTimeField()),
+            ],
+            options={
+                'indexes': [models.Index(fields=['name', 'taken'], name='awl_counter_name_b0fd1d_idx')],
+            },
+        ),
+    ]
@@ -1,31 +1,925 @@
-from itertools import islice, chain
-from django.db import models, transaction
+import asyncio
+import heapq
+import json
+import logging
+import random
+import sys
+import threading
+import time
+import uuid
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from bisect import bisect_right
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from datetime import (date, datetime, time as dt_time, timedelta,
+    timezone as dt_timezone)
+from decimal import Decimal
+from itertools import chain, islice
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import FieldError
+from django.db import (close_old_connections, connections, models, router,
+    transaction, IntegrityError, OperationalError)
+from django.db.transaction import TransactionManagementError
+from django.db.models import Case, F, Max, Q, Sum, Value, When
+from django.db.models.functions import Coalesce, Collate
+from django.db.models.query import (FlatValuesListIterable,
+    NamedValuesListIterable, ValuesIterable, ValuesListIterable)
+from django.db.models.sql import UpdateQuery
+from django.utils import timezone
+from django.utils.functional import cached_property
 
 from awl.absmodels import TimeTrackModel
+from awl.lockstats import lock_stats
+from awl.utils import get_obj_attr
+
+logger = logging.getLogger(__name__)
+
+# ============================================================================
+# Utilities
+# ============================================================================
+
+def _can_update_returning(connection):
+    # PostgreSQL and SQLite 3.35+ both support "UPDATE ... RETURNING", MySQL
+    # and MariaDB do not
+    if connection.vendor == 'postgresql':
+        return True
+
+    if connection.vendor == 'sqlite':
+        return connection.Database.sqlite_version_info >= (3, 35, 0)
+
+    return False
+
+
+def _add_to_value(queryset, delta, **changes):
+    # Adds "delta" to the "value" column of the row matched by the queryset
+    # using a single UPDATE, returns the new value or None if nothing matched.
+    # Any other field changes are passed through as keyword arguments
+    changes['value'] = F('value') + delta
+    connection = connections[queryset.db]
+    if _can_update_returning(connection):
+        query = queryset.query.chain(UpdateQuery)
+        query.add_update_values(changes)
+        sql, params = query.get_compiler(queryset.db).as_sql()
+        sql += ' RETURNING %s' % connection.ops.quote_name('value')
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            row = cursor.fetchone()
+
+        return None if row is None else row[0]
+
+    with transaction.atomic(using=queryset.db):
+        if not queryset.update(**changes):
+            return None
+
+        return queryset.values_list('value', flat=True)[0]
+
+
+def _db_alias(model, using):
+    # picks the database for a Counter or Lock call: the "using" argument,
+    # then the AWL_DATABASE setting, then whatever the routers choose for
+    # writes.  Reads go to the same place so values are never stale
+    if using is not None:
+        return using
+
+    alias = getattr(settings, 'AWL_DATABASE', None)
+    if alias is not None:
+        return alias
+
+    return router.db_for_write(model)
+
+
+def _create_named(model, names, using):
+    # makes sure rows with the given names exist using a single "INSERT ...
+    # ON CONFLICT DO NOTHING" (or the backend's equivalent)
+    model.objects.using(using).bulk_create([model(name=name)
+        for name in names], ignore_conflicts=True)
+
+
+def _shard_index(num_shards, shard):
+    # picks which shard of a sharded counter to update
+    if shard is None:
+        return random.randrange(num_shards)
+
+    return shard % num_shards
+
+
+def _share_clause(connection):
+    # returns the locking clause for a shared row lock, or None if the
+    # backend doesn't have one
+    if connection.vendor == 'postgresql':
+        return 'FOR SHARE'
+
+    if connection.vendor == 'mysql':
+        if connection.mysql_is_mariadb:
+            return 'LOCK IN SHARE MODE'
+
+        return 'FOR SHARE'
+
+    return None
+
+
+def _shared_lock_sql(queryset, clause, nowait=False, skip_locked=False):
+    # Django's select_for_update() only does exclusive locks, compile the
+    # query and add the shared locking clause by hand
+    sql, params = queryset.query.get_compiler(queryset.db).as_sql()
+    sql += ' ' + clause
+    if nowait:
+        sql += ' NOWAIT'
+    elif skip_locked:
+        sql += ' SKIP LOCKED'
+
+    return sql, params
+
+
+def _held_locks(connection):
+    # locks taken by Lock.lock_until_commit() or Lock.lock_many() in the
+    # connection's transactions, maps names to (shared, marker) pairs where
+    # the marker is the on_commit() callback that forgets the lock
+    held = getattr(connection, '_awl_held_locks', None)
+    if held is None:
+        held = {}
+        connection._awl_held_locks = held
+
+    return held
+
+
+# Lock.alock() blocks entered by the current task or the tasks that started
+# it, as (database alias, atomic) pairs
+_alock_blocks = ContextVar('awl_alock_blocks', default=())
+
+
+def _alock_stack(connection):
+    # Lock.alock() blocks open on the connection, innermost last
+    stack = getattr(connection, '_awl_alock_stack', None)
+    if stack is None:
+        stack = []
+        connection._awl_alock_stack = stack
+
+    return stack
+
+
+def _bucket_start(when, resolution):
+    # floors a datetime to the start of its "resolution" second long bucket,
+    # buckets are aligned to the UTC epoch
+    if timezone.is_naive(when):
+        when = timezone.make_aware(when)
+
+    seconds = int(when.timestamp()) // resolution * resolution
+    start = datetime.fromtimestamp(seconds, tz=dt_timezone.utc)
+    if not settings.USE_TZ:
+        start = timezone.make_naive(start)
+
+    return start
+
+# ============================================================================
+# Exceptions
+# ============================================================================
+
+class LockContention(Exception):
+    """Raised when a :class:`Lock` is held elsewhere and the caller asked not
+    to wait for it, or not to wait as long as it took."""
 
 # ============================================================================
 # Concrete Models
 # ============================================================================
 
 class Counter(TimeTrackModel):
-    """A named counter in the database with atomic update."""
-    name = models.CharField(max_length=30)
+    """A named counter in the database with atomic update.  Counters are
+    created on first use, there is no need to create them ahead of time.
+
+    Counters that are incremented by many workers at once can be spread
+    across several shard rows (see :meth:`Counter.set_shards`), each
+    increment only touches a single shard and reads sum them back up.
+    """
+    name = models.CharField(max_length=30, unique=True)
     value = models.BigIntegerField(default=0)
+    num_shards = models.PositiveSmallIntegerField(default=0)
 
     @classmethod
-    def increment(cls, name):
+    def increment(cls, name, delta=1, shard=None, using=None):
         """Call this method to increment the named counter.  This is atomic on
-        the database.
+        the database, the change is done with a single ``UPDATE`` statement
+        rather than a locked read-modify-write.  Backends that support
+        ``UPDATE ... RETURNING`` get the new value back in the same statement,
+        others re-read the row inside the same transaction.
+
+        If the counter has been sharded only one of the shard rows is
+        updated, the parent row is not locked and its ``updated`` timestamp
+        is left alone.
+
+        :param name:
+            Name of the counter, it is created if it doesn't exist
+        :param delta:
+            Amount to change the counter by, can be negative.  Defaults to 1.
+        :param shard:
+            Only used for sharded counters.  Integer used to pick the shard
+            row (modulo the number of shards), for example ``os.getpid()``
+            to keep each worker on its own shard.  Defaults to None, meaning
+            a shard is chosen at random.
+        :param using:
+            Alias of the database to use.  Defaults to None, see
+            :ref:`counter-lock-database`.
+        :returns:
+            The new value of the counter.  For sharded counters this is the
+            sum of all shards just after the update, which may include other
+            workers' concurrent increments.
+        """
+        using = _db_alias(cls, using)
+        started = time.monotonic()
+        while True:
+            value = _add_to_value(cls.objects.using(using).filter(name=name,
+                num_shards=0), delta, updated=timezone.now())
+            if value is not None:
+                lock_stats.record('counter', name, started, using=using)
+                return value
+
+            # either the counter doesn't exist or it is sharded
+            info = cls.objects.using(using).filter(name=name).values_list('id',
+                'num_shards').first()
+            if info is None:
+                _create_named(cls, [name], using)
+                continue
+
+            counter_id, num_shards = info
+            if num_shards == 0:
+                # un-sharded between the two queries, try again
+                continue
+
+            if cls._add_to_shard(using, counter_id, num_shards, delta, shard):
+                lock_stats.record('counter', name, started, using=using)
+                return cls.get_value(name, using=using)
+
+            # shard was removed by a concurrent set_shards(), try again
+
+    @classmethod
+    async def aincrement(cls, name, delta=1, shard=None, using=None):
+        """Async version of :meth:`Counter.increment`.  The whole increment
+        runs in a single hop to Django's async ORM thread, and returns the
+        same value the sync version does.
+
+        :param name:
+            Name of the counter, it is created if it doesn't exist
+        :param delta:
+            Amount to change the counter by, can be negative.  Defaults to 1.
+        :param shard:
+            See :meth:`Counter.increment`
+        :param using:
+            Alias of the database to use.  Defaults to None, see
+            :ref:`counter-lock-database`.
+        :returns:
+            The new value of the counter, see :meth:`Counter.increment`
+        """
+        return await sync_to_async(cls.increment)(name, delta, shard, using)
+
+    @classmethod
+    def _add_to_shard(cls, using, counter_id, num_shards, delta, shard=None):
+        # adds delta to one of the counter's shards, returns False if the
+        # chosen shard no longer exists
+        shards = CounterShard.objects.using(using).filter(
+            counter_id=counter_id, index=_shard_index(num_shards, shard))
+        return _add_to_value(shards, delta) is not None
+
+    @classmethod
+    def increment_many(cls, deltas, using=None):
+        """Applies several increments in a single transaction.  Un-sharded
+        counters are locked with one ``SELECT ... FOR UPDATE`` in name order,
+        so concurrent callers can't deadlock, and are then all changed by one
+        ``UPDATE`` statement.  Sharded counters have one of their shards
+        updated, also in name order.  Missing counters are created.
+
+        :param deltas:
+            Dictionary mapping counter names to the amount to change them by
+        :param using:
+            Alias of the database to use.  Defaults to None, see
+            :ref:`counter-lock-database`.
+        :returns:
+            Dictionary mapping the counter names to their new values
+        """
+        if not deltas:
+            return {}
+
+        using = _db_alias(cls, using)
+        with transaction.atomic(using=using):
+            started = time.monotonic()
+            locked = cls.objects.using(using).select_for_update()
+            unsharded = list(locked.filter(name__in=deltas,
+                num_shards=0).order_by('name').values_list('name', flat=True))
+
+            if unsharded:
+                lock_stats.record('counter', unsharded, started, using=using)
+                cases = [When(name=name, then=Value(deltas[name]))
+                    for name in unsharded]
+                cls.objects.using(using).filter(name__in=unsharded).update(
+                    value=F('value') + Case(*cases,
+                        output_field=models.BigIntegerField()),
+                    updated=timezone.now())
+
+            # anything left over is either sharded or missing
+            leftover = set(deltas.keys()) - set(unsharded)
+            if leftover:
+                sharded = cls.objects.using(using).filter(
+                    name__in=leftover).order_by('name').values_list('name',
+                    'id', 'num_shards')
+
+                for name, counter_id, num_shards in sharded:
+                    leftover.remove(name)
+                    if num_shards == 0 or not cls._add_to_shard(using,
+                            counter_id, num_shards, deltas[name]):
+                        # sharding changed under us, take the slow path
+                        cls.increment(name, deltas[name], using=using)
+
+                if leftover:
+                    _create_named(cls, leftover, using)
+                    for name in sorted(leftover):
+                        cls.increment(name, deltas[name], using=using)
+
+            return cls.get_values(deltas.keys(), using=using)
+
+    @classmethod
+    def add_many(cls, deltas, using=None, written=None):
+        """Like :meth:`Counter.increment_many` but without reading the new
+        values back, for writers that don't need them.  On backends that
+        support ``UPDATE ... RETURNING`` (PostgreSQL, SQLite 3.35+) existing
+        un-sharded counters are all changed by a single ``UPDATE`` with a
+        ``CASE`` per name, outside of any transaction.  The rows are locked
+        in the order the database visits them rather than by name.  Sharded
+        and missing counters, or everything on other backends, go through
+        :meth:`Counter.increment_many`.
+
+        :param deltas:
+            Dictionary mapping counter names to the amount to change them by
+        :param using:
+            Alias of the database to use.  Defaults to None, see
+            :ref:`counter-lock-database`.
+        :param written:
+            Optional set that the names are added to once their changes are
+            committed, so a caller can tell what was written if an exception
+            is raised part way through.  Defaults to None.
+        """
+        if written is None:
+            written = set()
+
+        if not deltas:
+            return
+
+        using = _db_alias(cls, using)
+        connection = connections[using]
+        if not _can_update_returning(connection):
+            cls.increment_many(deltas, using=using)
+            written.update(deltas)
+            return
+
+        started = time.monotonic()
+        cases = [When(name=name, then=Value(delta))
+            for name, delta in deltas.items()]
+        query = cls.objects.using(using).filter(name__in=deltas,
+            num_shards=0).query.chain(UpdateQuery)
+        query.add_update_values({
+            'value':F('value') + Case(*cases,
+                output_field=models.BigIntegerField()),
+            'updated':timezone.now(),
+        })
+        sql, params = query.get_compiler(using).as_sql()
+        sql += ' RETURNING %s' % connection.ops.quote_name('name')
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            done = {row[0] for row in cursor.fetchall()}
+
+        if done:
+            lock_stats.record('counter', sorted(done), started, using=using)
+            written.update(done)
+
+        leftover = {name:delta for name, delta in deltas.items()
+            if name not in done}
+        if leftover:
+            cls.increment_many(leftover, using=using)
+            written.update(leftover)
+
+    @classmethod
+    def reserve(cls, name, count, using=None):
+        """Atomically advances the named counter by ``count`` and returns the
+        block of values that were skipped over, so they can be handed out
+        without further database access.  See
+        :class:`awl.counters.BlockAllocator`.
+
+        :param name:
+            Name of an un-sharded counter, it is created if it doesn't exist
+        :param count:
+            Number of values to reserve, at least 1
+        :param using:
+            Alias of the database to use.  Defaults to None, see
+            :ref:`counter-lock-database`.
+        :returns:
+            A ``range`` containing the reserved values
+        :raises:
+            ``ValueError`` if the counter is sharded or ``count`` is less
+            than 1
+        """
+        if count < 1:
+            raise ValueError('Must reserve at least one value, not %s' % count)
+
+        using = _db_alias(cls, using)
+        counters = cls.objects.using(using).filter(name=name, num_shards=0)
+        last = _add_to_value(counters, count, updated=timezone.now())
+        if last is None:
+            if cls.objects.using(using).filter(name=name).exists():
+                raise ValueError('Cannot reserve values from sharded Counter '
+                    '"%s"' % name)
+
+            _create_named(cls, [name], using)
+            last = _add_to_value(counters, count, updated=timezone.now())
+
+        return range(last - count + 1, last + 1)
+
+    @classmethod
+    def get_value(cls, name, using=None):
+        """Returns the current value of the named counter, including the sum
+        of any shards.
 
         :param name:
             Name for a previously created ``Counter`` object
+        :param using:
+            Alias of the database to use.  Defaults to None, see
+            :ref:`counter-lock-database`.
+        :raises:
+            ``Counter.DoesNotExist`` if there is no counter with the given
+            name
         """
-        with transaction.atomic():
-            counter = Counter.objects.select_for_update().get(name=name)
-            counter.value += 1
+        values = cls.get_values([name], using=using)
+        if name not in values:
+            raise cls.DoesNotExist('Counter "%s" does not exist' % name)
+
+        return values[name]
+
+    @classmethod
+    def get_values(cls, names, using=None):
+        """Returns the current values of several counters using a single
+        query.
+
+        :param names:
+            Iterable of counter names
+        :param using:
+            Alias of the database to use.  Defaults to None, see
+            :ref:`counter-lock-database`.
+        :returns:
+            Dictionary mapping counter names to their values, names that
+            aren't counters are left out
+        """
+        using = _db_alias(cls, using)
+        return dict(cls.objects.using(using).filter(name__in=names).annotate(
+            total=F('value') + Coalesce(Sum('shards__value'), 0,
+                output_field=models.BigIntegerField())
+        ).values_list('name', 'total'))
+
+    @classmethod
+    async def aget_value(cls, name, using=None):
+        """Async version of :meth:`Counter.get_value`."""
+        values = await cls.aget_values([name], using=using)
+        if name not in values:
+            raise cls.DoesNotExist('Counter "%s" does not exist' % name)
+
+        return values[name]
+
+    @classmethod
+    async def aget_values(cls, names, using=None):
+        """Async version of :meth:`Counter.get_values`."""
+        using = _db_alias(cls, using)
+        rows = cls.objects.using(using).filter(name__in=names).annotate(
+            total=F('value') + Coalesce(Sum('shards__value'), 0,
+                output_field=models.BigIntegerField())
+        ).values_list('name', 'total')
+
+        return {name:total async for name, total in rows}
+
+    @classmethod
+    def set_shards(cls, name, num_shards, using=None):
+        """Converts an existing counter in place to be spread across
+        ``num_shards`` rows, or changes the number of shards of an already
+        sharded counter.  The total value is preserved: shards that are
+        removed have their values folded back into the parent row.  Setting
+        ``num_shards`` to 0 turns the counter back into a single row.
+
+        Safe to call while the counter is in use and from a data migration.
+
+        :param name:
+            Name of the counter, it is created if it doesn't exist
+        :param num_shards:
+            Number of shard rows to spread the counter across
+        :param using:
+            Alias of the database to use.  Defaults to None, see
+            :ref:`counter-lock-database`.
+        """
+        using = _db_alias(cls, using)
+        with transaction.atomic(using=using):
+            _create_named(cls, [name], using)
+            counter = cls.objects.using(using).select_for_update().get(
+                name=name)
+
+            removed = counter.shards.select_for_update().filter(
+                index__gte=num_shards)
+            folded = sum(removed.values_list('value', flat=True))
+            removed.delete()
+
+            CounterShard.objects.using(using).bulk_create([
+                CounterShard(counter=counter, index=index)
+                for index in range(num_shards)
+            ], ignore_conflicts=True)
+
+            counter.value += folded
+            counter.num_shards = num_shards
             counter.save()
 
-        return counter.value
+
+class CounterShard(models.Model):
+    """One slice of a sharded :class:`Counter`, see
+    :meth:`Counter.set_shards`.
+    """
+    counter = models.ForeignKey(Counter, related_name='shards',
+        on_delete=models.CASCADE)
+    index = models.PositiveSmallIntegerField()
+    value = models.BigIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('counter', 'index')
+
+
+class RateCounter(models.Model):
+    """Counts events in fixed size time buckets, for "events per minute"
+    style questions.  Each row holds the count for one name, bucket size
+    (``resolution``, in seconds) and bucket start time.  Buckets are aligned
+    to the UTC epoch, so day buckets start at midnight UTC.
+
+    .. code-block:: python
+
+        # count in both minute and hour buckets
+        RateCounter.increment('signups',
+            resolutions=[RateCounter.MINUTE, RateCounter.HOUR])
+
+        # signups per minute over the last hour
+        now = timezone.now()
+        RateCounter.series('signups', RateCounter.MINUTE,
+            now - timedelta(hours=1), now)
+
+        # nightly: fold old minute buckets into hours, drop old hours
+        RateCounter.rollup(RateCounter.MINUTE, RateCounter.HOUR,
+            before=now - timedelta(days=1))
+        RateCounter.prune(RateCounter.HOUR, now - timedelta(days=90))
+
+    Rows are created on demand using an ``INSERT ... ON CONFLICT DO UPDATE``
+    (or ``ON DUPLICATE KEY UPDATE`` on MySQL) so an increment is a single
+    statement.
+    """
+    MINUTE = 60
+    HOUR = 60 * 60
+    DAY = 24 * 60 * 60
+
+    name = models.CharField(max_length=30)
+    resolution = models.PositiveIntegerField()
+    start = models.DateTimeField()
+    value = models.BigIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('name', 'resolution', 'start')
+
+    @classmethod
+    def increment(cls, name, delta=1, when=None, resolutions=(MINUTE,)):
+        """Adds ``delta`` to the buckets containing ``when``.
+
+        :param name:
+            Name of the counter, buckets are created as needed
+        :param delta:
+            Amount to change the counter by, can be negative.  Defaults to 1.
+        :param when:
+            Date/time of the event.  Defaults to now.
+        :param resolutions:
+            Sequence of bucket sizes in seconds to count in.  Defaults to
+            ``[RateCounter.MINUTE]``.
+        """
+        if when is None:
+            when = timezone.now()
+
+        cls._upsert_add([(name, resolution, _bucket_start(when, resolution),
+            delta) for resolution in resolutions])
+
+    @classmethod
+    def _upsert_add(cls, rows):
+        # adds to (or creates) the buckets described by the (name, resolution,
+        # start, delta) tuples in "rows"
+        if not rows:
+            return
+
+        connection = connections[cls.objects.db]
+        features = connection.features
+        if not (features.supports_update_conflicts_with_target or
+                features.supports_update_conflicts):
+            for name, resolution, start, delta in rows:
+                cls._upsert_add_row(name, resolution, start, delta)
+
+            return
+
+        qn = connection.ops.quote_name
+        table = qn(cls._meta.db_table)
+        value = qn('value')
+        columns = ', '.join(qn(column) for column in
+            ('name', 'resolution', 'start', 'value'))
+
+        params = []
+        for name, resolution, start, delta in rows:
+            params.extend([name, resolution,
+                connection.ops.adapt_datetimefield_value(start), delta])
+
+        sql = 'INSERT INTO %s (%s) VALUES %s' % (table, columns,
+            ', '.join(['(%s, %s, %s, %s)'] * len(rows)))
+        if features.supports_update_conflicts_with_target:
+            sql += (' ON CONFLICT (%s, %s, %s) DO UPDATE SET %s = %s.%s + '
+                'EXCLUDED.%s') % (qn('name'), qn('resolution'), qn('start'),
+                value, table, value, value)
+        else:
+            sql += ' ON DUPLICATE KEY UPDATE %s = %s + VALUES(%s)' % (value,
+                value, value)
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+
+    @classmethod
+    def _upsert_add_row(cls, name, resolution, start, delta):
+        # update-or-create for backends without upsert support
+        buckets = cls.objects.filter(name=name, resolution=resolution,
+            start=start)
+        if buckets.update(value=F('value') + delta):
+            return
+
+        try:
+            with transaction.atomic():
+                cls.objects.create(name=name, resolution=resolution,
+                    start=start, value=delta)
+        except IntegrityError:
+            # someone else created it first
+            buckets.update(value=F('value') + delta)
+
+    @classmethod
+    def series(cls, name, resolution, start, end):
+        """Returns the counts for a range of buckets using a single query.
+        Buckets with no events are included with a count of zero.
+
+        :param name:
+            Name of the counter
+        :param resolution:
+            Bucket size in seconds
+        :param start:
+            Date/time to start from, the bucket containing it is the first
+            one returned
+        :param end:
+            Date/time to stop at, buckets starting at or after this are not
+            included
+        :returns:
+            List of ``(bucket_start, value)`` tuples
+        """
+        first = _bucket_start(start, resolution)
+        counts = dict(cls.objects.filter(name=name, resolution=resolution,
+            start__gte=first, start__lt=end).values_list('start', 'value'))
+
+        result = []
+        step = timedelta(seconds=resolution)
+        bucket = first
+        while bucket < end:
+            result.append((bucket, counts.get(bucket, 0)))
+            bucket += step
+
+        return result
+
+    @classmethod
+    def rollup(cls, from_resolution, to_resolution, before=None, name=None):
+        """Folds fine grained buckets into coarser ones, deleting the fine
+        ones.  Only coarse buckets that are complete before ``before`` are
+        built, so this can be run repeatedly.
+
+        :param from_resolution:
+            Bucket size in seconds of the buckets to fold
+        :param to_resolution:
+            Bucket size in seconds of the buckets to fold into, should be a
+            multiple of ``from_resolution``
+        :param before:
+            Only buckets before this date/time are folded.  Defaults to now.
+        :param name:
+            Only fold buckets for this counter.  Defaults to None, meaning all
+            counters.
+        :returns:
+            Number of fine buckets that were folded
+        """
+        if before is None:
+            before = timezone.now()
+
+        before = _bucket_start(before, to_resolution)
+        with transaction.atomic():
+            fine = cls.objects.select_for_update().filter(
+                resolution=from_resolution, start__lt=before)
+            if name is not None:
+                fine = fine.filter(name=name)
+
+            ids = []
+            totals = {}
+            for pk, bucket_name, start, value in fine.values_list('id',
+                    'name', 'start', 'value'):
+                ids.append(pk)
+                key = (bucket_name, _bucket_start(start, to_resolution))
+                totals[key] = totals.get(key, 0) + value
+
+            cls._upsert_add([(bucket_name, to_resolution, start, value)
+                for (bucket_name, start), value in totals.items()])
+            cls.objects.filter(id__in=ids).delete()
+
+        return len(ids)
+
+    @classmethod
+    def prune(cls, resolution, before, name=None):
+        """Deletes expired buckets.
+
+        :param resolution:
+            Bucket size in seconds of the buckets to delete
+        :param before:
+            Buckets starting before this date/time are deleted
+        :param name:
+            Only delete buckets for this counter.  Defaults to None, meaning
+            all counters.
+        :returns:
+            Number of buckets deleted
+        """
+        buckets = cls.objects.filter(resolution=resolution, start__lt=before)
+        if name is not None:
+            buckets = buckets.filter(name=name)
+
+        return buckets.delete()[0]
+
+
+class CounterSnapshot(models.Model):
+    """History of :class:`Counter` values, one row per counter each time a
+    snapshot is taken.  Trend questions can then be answered from this
+    indexed table instead of polling the live counters.
+
+    .. code-block:: python
+
+        # cron, every minute; only writes if the last snapshot is 5+ minutes
+        # old
+        CounterSnapshot.maybe_take(interval=300)
+
+        # signups over the last day
+        now = timezone.now()
+        CounterSnapshot.delta('signups', now - timedelta(days=1), now)
+
+    The ``snapshot_counters`` management command does the same from the
+    command line.  Snapshots are only as fine grained as they are taken,
+    for per-minute counting of events see :class:`RateCounter`.
+    """
+    name = models.CharField(max_length=30)
+    value = models.BigIntegerField()
+    taken = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['name', 'taken']),
+        ]
+
+    @classmethod
+    def take(cls, names=None, when=None, using=None):
+        """Records the current value of the counters.  The values are read
+        with a single query and written with a single bulk insert.
+
+        :param names:
+            Iterable of names of the counters to record.  Defaults to None,
+            meaning all counters.
+        :param when:
+            Time stamp for the snapshot.  Defaults to now.
+        :param using:
+            Alias of the database to use.  Defaults to None, see
+            :ref:`counter-lock-database`.
+        :returns:
+            Number of snapshot rows written
+        """
+        using = _db_alias(cls, using)
+        if when is None:
+            when = timezone.now()
+
+        if names is None:
+            names = Counter.objects.using(using).values_list('name',
+                flat=True)
+
+        values = Counter.get_values(names, using=using)
+        cls.objects.using(using).bulk_create([cls(name=name, value=value,
+            taken=when) for name, value in values.items()])
+        return len(values)
+
+    @classmethod
+    def maybe_take(cls, interval, names=None, using=None):
+        """Calls :meth:`CounterSnapshot.take` if no snapshot has been taken
+        in the last ``interval`` seconds.  Meant to be called frequently, for
+        example from a cron job or at the end of a request, to get snapshots
+        at a fixed cadence.  Two processes calling this at the same moment
+        can both take a snapshot.
+
+        :param interval:
+            Minimum number of seconds between snapshots
+        :param names:
+            See :meth:`CounterSnapshot.take`
+        :param using:
+            Alias of the database to use.  Defaults to None, see
+            :ref:`counter-lock-database`.
+        :returns:
+            Number of snapshot rows written, 0 if it wasn't time yet
+        """
+        using = _db_alias(cls, using)
+        now = timezone.now()
+        snapshots = cls.objects.using(using)
+        if names is not None:
+            names = list(names)
+            snapshots = snapshots.filter(name__in=names)
+
+        latest = snapshots.aggregate(latest=Max('taken'))['latest']
+        if latest is not None and latest > now - timedelta(seconds=interval):
+            return 0
+
+        return cls.take(names, now, using)
+
+    @classmethod
+    def series(cls, name, start, end, using=None):
+        """Returns the recorded values of a counter over a time range using
+        a single query.
+
+        :param name:
+            Name of the counter
+        :param start:
+            Date/time to start from, inclusive
+        :param end:
+            Date/time to stop at, exclusive
+        :param using:
+            Alias of the database to use.  Defaults to None, see
+            :ref:`counter-lock-database`.
+        :returns:
+            List of ``(taken, value)`` tuples in time order
+        """
+        using = _db_alias(cls, using)
+        return list(cls.objects.using(using).filter(name=name,
+            taken__gte=start, taken__lt=end).order_by('taken').values_list(
+            'taken', 'value'))
+
+    @classmethod
+    def delta(cls, name, start, end, using=None):
+        """Returns how much a counter changed over a time range, based on
+        the last snapshot at or before each end of the range.  If there is
+        no snapshot before ``start`` the first one after it is used.
+
+        :param name:
+            Name of the counter
+        :param start:
+            Date/time the range starts at
+        :param end:
+            Date/time the range ends at
+        :param using:
+            Alias of the database to use.  Defaults to None, see
+            :ref:`counter-lock-database`.
+        :returns:
+            Difference between the two snapshot values, or None if there
+            aren't snapshots covering the range
+        """
+        using = _db_alias(cls, using)
+        snapshots = cls.objects.using(using).filter(name=name)
+        values = snapshots.values_list('value', flat=True)
+
+        first = values.filter(taken__lte=start).order_by('-taken').first()
+        if first is None:
+            first = values.filter(taken__gt=start,
+                taken__lte=end).order_by('taken').first()
+
+        last = values.filter(taken__lte=end).order_by('-taken').first()
+        if first is None or last is None:
+            return None
+
+        return last - first
+
+    @classmethod
+    def prune(cls, before, name=None, using=None):
+        """Deletes old snapshots.
+
+        :param before:
+            Snapshots taken before this date/time are deleted
+        :param name:
+            Only delete snapshots for this counter.  Defaults to None,
+            meaning all counters.
+        :param using:
+            Alias of the database to use.  Defaults to None, see
+            :ref:`counter-lock-database`.
+        :returns:
+            Number of snapshots deleted
+        """
+        using = _db_alias(cls, using)
+        snapshots = cls.objects.using(using).filter(taken__lt=before)
+        if name is not None:
+            snapshots = snapshots.filter(name=name)
+
+        return snapshots.delete()[0]
 
 
 class Lock(TimeTrackModel):
@@ -34,25 +928,596 @@ class Lock(TimeTrackModel):
 
     .. code-block:: python
 
-        # run once, or use a fixture
-        Lock.objects.create(name='everything')
-
         # views.py
         def something(request):
             Lock.lock_until_commit('everything')
 
+    Locks are created on first use.  Code that only needs to keep writers
+    out can take a shared lock with ``lock_until_commit(name, shared=True)``.
+
+    For work that runs longer than a transaction should stay open, a lock
+    can also be held as a lease, see :meth:`Lock.lease`.  Leases and
+    ``lock_until_commit`` are independent of each other, a row can be used
+    for both.
     """
-    name = models.CharField(max_length=30)
+    name = models.CharField(max_length=30, unique=True)
+    owner = models.CharField(max_length=32, blank=True, default='')
+    expires = models.DateTimeField(null=True, blank=True)
 
     @classmethod
-    def lock_until_commit(cls, name):
+    def lock_until_commit(cls, name, nowait=False, skip_locked=False,
+            timeout=None, shared=False, using=None):
         """Grabs this lock and holds it (using ``select_for_update()``) until
-        the next commit is done.
+        the next commit is done.  By default this waits for as long as it
+        takes for any other holder to finish, the optional arguments allow
+        giving up instead.
+
+        Passing ``shared=True`` takes a shared (reader) lock instead of an
+        exclusive (writer) one: any number of readers can hold the lock at
+        the same time, but they keep writers out and wait for them.  This
+        uses ``FOR SHARE`` on PostgreSQL and MySQL and ``LOCK IN SHARE MODE``
+        on MariaDB.  Other backends fall back to an exclusive lock, which is
+        still correct but means readers wait for each other.
+
+        Locks taken are remembered until the transaction ends, asking again
+        for a lock the current transaction already holds returns straight
+        away without a query.  Rolling back a savepoint the lock was taken in
+        releases it, so it is forgotten as well.
+
+        These options depend on the database supporting ``NOWAIT`` and ``SKIP
+        LOCKED``.  SQLite locks the whole database on write, has no row
+        locks, and so ignores them.
+
+        On databases with row locks this must be called inside a
+        transaction, otherwise the lock would be released as soon as it was
+        taken.
 
         :param name:
-            Name for a previously created ``Lock`` object
+            Name of the lock, it is created if it doesn't exist
+        :param nowait:
+            If True, raise :class:`LockContention` immediately when someone
+            else holds the lock.  Defaults to False.
+        :param skip_locked:
+            If True, don't wait for the lock, return False instead when
+            someone else holds it.  Defaults to False.
+        :param timeout:
+            Maximum number of seconds to wait for the lock before raising
+            :class:`LockContention`.  Uses ``lock_timeout`` on PostgreSQL,
+            ``innodb_lock_wait_timeout`` on MySQL, and polling with ``NOWAIT``
+            on other backends.  Defaults to None, meaning wait forever.
+        :param shared:
+            If True, take a shared lock instead of an exclusive one.
+            Defaults to False.
+        :param using:
+            Alias of the database to use.  Defaults to None, see
+            :ref:`counter-lock-database`.
+        :returns:
+            True if the lock was acquired, or is already held by the current
+            transaction, False if ``skip_locked`` was set
+            and the lock is held elsewhere
+        :raises:
+            :class:`LockContention` if ``nowait`` or ``timeout`` was set and
+            the lock could not be acquired, ``TransactionManagementError`` if
+            called outside of a transaction on a database with row locks
+        """
+        using = _db_alias(cls, using)
+        connection = transaction.get_connection(using)
+        if connection.features.has_select_for_update and \
+                not connection.in_atomic_block:
+            # the savepoints used by "nowait" and "timeout" would otherwise
+            # commit, releasing the lock before it is returned
+            raise TransactionManagementError('Locks cannot be taken outside '
+                'of a transaction.')
+
+        if cls._is_held(connection, name, shared):
+            return True
+
+        started = time.monotonic()
+        try:
+            if skip_locked:
+                acquired = cls._select_lock(using, name, shared,
+                    skip_locked=True)
+            else:
+                if timeout is not None:
+                    cls._lock_with_timeout(using, name, timeout, shared)
+                elif nowait:
+                    cls._lock_nowait(using, name, shared)
+                else:
+                    cls._select_lock(using, name, shared)
+
+                acquired = True
+        except LockContention:
+            lock_stats.record('lock', name, started, acquired=False,
+                using=using)
+            raise
+
+        lock_stats.record('lock', name, started, acquired=acquired,
+            using=using)
+        if acquired:
+            cls._remember(connection, [name], shared)
+
+        return acquired
+
+    @classmethod
+    def lock_many(cls, names, create=True, using=None):
+        """Grabs several locks at once, holding them until the next commit.
+        The rows are locked with a single ``SELECT ... FOR UPDATE`` ordered by
+        name, so callers asking for the same locks in a different order can't
+        deadlock each other.
+
+        :param names:
+            Iterable of lock names
+        :param create:
+            If True, locks that don't exist are created and locked as well.
+            Defaults to True.
+        :param using:
+            Alias of the database to use.  Defaults to None, see
+            :ref:`counter-lock-database`.
+        :returns:
+            Sorted list of the names that didn't exist
+        :raises:
+            ``Lock.DoesNotExist`` if ``create`` is False and any of the locks
+            don't exist
         """
-        Lock.objects.select_for_update().get(name=name)
+        using = _db_alias(cls, using)
+        connection = transaction.get_connection(using)
+        names = [name for name in sorted(set(names)) if not cls._is_held(
+            connection, name, False)]
+        if not names:
+            return []
+
+        started = time.monotonic()
+        found = set(cls.objects.using(using).select_for_update().filter(
+            name__in=names).order_by('name').values_list('name', flat=True))
+
+        missing = [name for name in names if name not in found]
+        if missing:
+            if not create:
+                raise cls.DoesNotExist('Locks do not exist: %s' % ', '.join(
+                    missing))
+
+            _create_named(cls, missing, using)
+            list(cls.objects.using(using).select_for_update().filter(
+                name__in=missing).order_by('name').values_list('id',
+                flat=True))
+
+        lock_stats.record('lock', names, started, using=using)
+        cls._remember(connection, names, False)
+        return missing
+
+    @classmethod
+    def _is_held(cls, connection, name, shared):
+        # True if the current transaction already holds the named lock, an
+        # exclusive lock covers a request for a shared one
+        held = _held_locks(connection)
+        if name not in held:
+            return False
+
+        held_shared, marker = held[name]
+
+        # rolling back a transaction or a savepoint releases the row locks
+        # taken inside it and discards its on_commit() callbacks, so the lock
+        # is only still held if the marker is still waiting to run
+        if not any(func is marker for _, func, _ in connection.run_on_commit):
+            del held[name]
+            return False
+
+        return shared or not held_shared
+
+    @classmethod
+    def _remember(cls, connection, names, shared):
+        # records locks held until the end of the current transaction
+        if not connection.in_atomic_block:
+            return
+
+        held = _held_locks(connection)
+        for name in names:
+            def forget(name=name):
+                held.pop(name, None)
+
+            held[name] = (shared, forget)
+            connection.on_commit(forget)
+
+    @classmethod
+    def _select_lock(cls, using, name, shared=False, **options):
+        # runs the SELECT ... FOR UPDATE (or FOR SHARE), creating the row if
+        # needed; returns False if the row exists but "skip_locked" skipped
+        # over it
+        def select():
+            rows = cls.objects.using(using).filter(name=name).values_list(
+                'id', flat=True)
+            if shared:
+                connection = connections[rows.db]
+                clause = _share_clause(connection)
+                if clause:
+                    if connection.get_autocommit():
+                        raise TransactionManagementError('Shared locks '
+                            'cannot be used outside of a transaction.')
+
+                    sql, params = _shared_lock_sql(rows, clause, **options)
+                    with connection.cursor() as cursor:
+                        cursor.execute(sql, params)
+                        return cursor.fetchall()
+
+            return list(rows.select_for_update(**options))
+
+        if select():
+            return True
+
+        if cls.objects.using(using).filter(name=name).exists():
+            return False
+
+        _create_named(cls, [name], using)
+        return bool(select())
+
+    @classmethod
+    def _lock_nowait(cls, using, name, shared=False):
+        # the caller's transaction holds the lock, the savepoint only means a
+        # failed attempt doesn't break that transaction on PostgreSQL
+        try:
+            with transaction.atomic(using=using):
+                cls._select_lock(using, name, shared, nowait=True)
+        except OperationalError as e:
+            raise LockContention('Lock "%s" is held elsewhere' % name) from e
+
+    @classmethod
+    def _lock_with_timeout(cls, using, name, timeout, shared=False):
+        connection = connections[using]
+        features = connection.features
+
+        if connection.vendor == 'postgresql':
+            cls._lock_with_setting(connection, name, shared, 'lock_timeout',
+                '%dms' % max(1, timeout * 1000))
+        elif connection.vendor == 'mysql':
+            cls._lock_with_setting(connection, name, shared,
+                'innodb_lock_wait_timeout', max(1, round(timeout)))
+        elif features.has_select_for_update_nowait:
+            # no server side timeout, poll instead
+            deadline = time.monotonic() + timeout
+            delay = 0.01
+            while True:
+                try:
+                    cls._lock_nowait(using, name, shared)
+                    return
+                except LockContention:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise
+
+                    time.sleep(min(delay, remaining))
+                    delay = min(delay * 2, 0.5)
+        else:
+            # no row locks (SQLite) or no way of not waiting
+            cls._select_lock(using, name, shared)
+
+    @classmethod
+    def _lock_with_setting(cls, connection, name, shared, setting, value):
+        # sets the server's lock wait timeout for the duration of a single
+        # lock attempt; the caller's transaction holds the lock, the savepoint
+        # only keeps that transaction usable if the attempt times out
+        if connection.vendor == 'postgresql':
+            get_sql = 'SELECT current_setting(%s)'
+            set_sql = 'SELECT set_config(%s, %s, true)'
+        else:
+            get_sql = 'SELECT @@SESSION.' + setting
+            set_sql = 'SET SESSION ' + setting + ' = %s'
+
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                cursor.execute(get_sql, [setting])
+                previous = cursor.fetchone()[0]
+                cursor.execute(set_sql, [setting, str(value)])
+            else:
+                cursor.execute(get_sql)
+                previous = cursor.fetchone()[0]
+                cursor.execute(set_sql, [value])
+
+        using = connection.alias
+        try:
+            with transaction.atomic(using=using):
+                cls._select_lock(using, name, shared)
+        except OperationalError as e:
+            raise LockContention('Timed out waiting for lock "%s"' % name) \
+                from e
+        finally:
+            with connection.cursor() as cursor:
+                if connection.vendor == 'postgresql':
+                    cursor.execute(set_sql, [setting, previous])
+                else:
+                    cursor.execute(set_sql, [previous])
+
+    @classmethod
+    @asynccontextmanager
+    async def alock(cls, name, **kwargs):
+        """Async context manager that opens a transaction and grabs the named
+        lock (see :meth:`Lock.lock_until_commit`), committing and so releasing
+        the lock on exit.
+
+        .. code-block:: python
+
+            async def something(request):
+                async with Lock.alock('everything'):
+                    await Thing.objects.acreate(...)
+
+                async with Lock.alock('reports', skip_locked=True) as got:
+                    if got:
+                        ...
+
+        Django runs the async ORM's queries on a single thread per request,
+        so queries in the block happen inside the lock's transaction.
+        Entering and leaving the block each cost one hop to that thread.
+
+        As every block in a request shares that thread's connection, their
+        transactions are savepoints of each other and have to be left in the
+        reverse order they were entered.  Blocks can be nested, but running
+        them concurrently in the same request, for example with
+        ``asyncio.gather()``, raises ``TransactionManagementError`` when the
+        second block is entered.
+
+        :param name:
+            Name of the lock, it is created if it doesn't exist
+        :param kwargs:
+            Passed to :meth:`Lock.lock_until_commit`, the result is the value
+            of the ``as`` target.  The transaction is opened on the database
+            given by ``using``.
+        """
+        using = kwargs['using'] = _db_alias(cls, kwargs.get('using'))
+        atomic = transaction.atomic(using=using)
+        blocks = _alock_blocks.get()
+
+        def enter():
+            # anything open on the connection must belong to this task's own
+            # enclosing blocks, otherwise another task's block is in progress
+            stack = _alock_stack(transaction.get_connection(using))
+            if stack != [block for alias, block in blocks if alias == using]:
+                raise TransactionManagementError('Lock.alock() blocks on the '
+                    'same connection can be nested but not run concurrently.')
+
+            atomic.__enter__()
+            try:
+                acquired = cls.lock_until_commit(name, **kwargs)
+            except BaseException:
+                atomic.__exit__(*sys.exc_info())
+                raise
+
+            stack.append(atomic)
+            return acquired
+
+        def exit(*exc_info):
+            _alock_stack(transaction.get_connection(using)).pop()
+            return atomic.__exit__(*exc_info)
+
+        acquired = await sync_to_async(enter)()
+        token = _alock_blocks.set(blocks + ((using, atomic), ))
+        try:
+            yield acquired
+        except BaseException as e:
+            suppress = await sync_to_async(exit)(type(e), e, e.__traceback__)
+            if not suppress:
+                raise
+        else:
+            await sync_to_async(exit)(None, None, None)
+        finally:
+            _alock_blocks.reset(token)
+
+    @classmethod
+    def acquire_lease(cls, name, ttl, owner=None, using=None):
+        """Tries to take the named lock as a lease: the lock's row is marked
+        with an owner token and an expiry time using a single ``UPDATE``, no
+        transaction is held.  Succeeds if nobody holds the lease, the current
+        lease has expired, or ``owner`` already holds it.
+
+        Should be called outside of ``transaction.atomic()``, otherwise other
+        processes won't see the lease until the transaction commits.
+
+        :param name:
+            Name of the lock, it is created if it doesn't exist
+        :param ttl:
+            Number of seconds the lease is good for
+        :param owner:
+            Token identifying the holder.  Defaults to None, meaning a new
+            random token is generated.
+        :param using:
+            Alias of the database to use.  Defaults to None, see
+            :ref:`counter-lock-database`.
+        :returns:
+            The owner token if the lease was acquired, None otherwise
+        """
+        using = _db_alias(cls, using)
+        if owner is None:
+            owner = uuid.uuid4().hex
+
+        now = timezone.now()
+        available = cls.objects.using(using).filter(Q(expires__isnull=True) |
+            Q(expires__lt=now) | Q(owner=owner), name=name)
+        changes = dict(owner=owner, expires=now + timedelta(seconds=ttl),
+            updated=now)
+
+        if available.update(**changes):
+            return owner
+
+        if cls.objects.using(using).filter(name=name).exists():
+            return None
+
+        _create_named(cls, [name], using)
+        if available.update(**changes):
+            return owner
+
+        return None
+
+    @classmethod
+    def renew_lease(cls, name, owner, ttl, using=None):
+        """Extends a lease held by ``owner``.  A lease that has expired can
+        still be renewed as long as nobody else has taken it.
+
+        :param name:
+            Name of the lock
+        :param owner:
+            Token returned by :meth:`Lock.acquire_lease`
+        :param ttl:
+            Number of seconds from now the lease is good for
+        :param using:
+            Alias of the database to use.  Defaults to None, see
+            :ref:`counter-lock-database`.
+        :returns:
+            True if the lease was renewed, False if ``owner`` no longer holds
+            it
+        """
+        using = _db_alias(cls, using)
+        now = timezone.now()
+        return bool(cls.objects.using(using).filter(name=name,
+            owner=owner).update(expires=now + timedelta(seconds=ttl),
+            updated=now))
+
+    @classmethod
+    def release_lease(cls, name, owner, using=None):
+        """Gives up a lease held by ``owner``.
+
+        :param name:
+            Name of the lock
+        :param owner:
+            Token returned by :meth:`Lock.acquire_lease`
+        :param using:
+            Alias of the database to use.  Defaults to None, see
+            :ref:`counter-lock-database`.
+        :returns:
+            True if the lease was released, False if ``owner`` no longer held
+            it
+        """
+        using = _db_alias(cls, using)
+        return bool(cls.objects.using(using).filter(name=name,
+            owner=owner).update(owner='', expires=None,
+            updated=timezone.now()))
+
+    @classmethod
+    def lease(cls, name, ttl=60, heartbeat=None, using=None):
+        """Returns a :class:`Lease` context manager for the named lock.
+
+        .. code-block:: python
+
+            with Lock.lease('nightly-report', ttl=120) as lease:
+                for chunk in work:
+                    if lease.lost:
+                        break
+
+                    process(chunk)
+
+        :param name:
+            Name of the lock, it is created if it doesn't exist
+        :param ttl:
+            Number of seconds the lease is good for between heartbeats.
+            Defaults to 60.
+        :param heartbeat:
+            Number of seconds between renewals done by a background thread.
+            Defaults to None, meaning a third of ``ttl``.  Use 0 to turn the
+            background thread off and call :meth:`Lease.renew` yourself.
+        :param using:
+            Alias of the database to use.  Defaults to None, see
+            :ref:`counter-lock-database`.
+        """
+        return Lease(name, ttl, heartbeat, using)
+
+
+class Lease:
+    """Context manager holding a :class:`Lock` as a lease, created by
+    :meth:`Lock.lease`.  On entry the lease is acquired, raising
+    :class:`LockContention` if someone else holds it, and a background thread
+    is started to renew it.  On exit the thread is stopped and the lease
+    released.
+
+    Errors while renewing are logged and the renewal retried, with stale
+    database connections closed first.  If no renewal succeeds before the
+    lease's ``ttl`` runs out, someone else may have taken it, so
+    :attr:`Lease.lost` is set and the thread stops.
+
+    :param name:
+        Name of the lock
+    :param ttl:
+        Number of seconds the lease is good for between renewals
+    :param heartbeat:
+        Number of seconds between renewals, None for a third of ``ttl``, 0
+        for no background renewal
+    :param using:
+        Alias of the database holding the lock, None for the default
+    """
+    def __init__(self, name, ttl, heartbeat=None, using=None):
+        self.name = name
+        self.ttl = ttl
+        self.heartbeat = ttl / 3 if heartbeat is None else heartbeat
+        self.using = using
+
+        self.owner = None
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = None
+        self._expires = None
+
+    def __enter__(self):
+        # measured before the query, so it is never later than the database's
+        # idea of the expiry
+        started = time.monotonic()
+        self.owner = Lock.acquire_lease(self.name, self.ttl,
+            using=self.using)
+        if self.owner is None:
+            raise LockContention('Lease on lock "%s" is held elsewhere' % (
+                self.name))
+
+        self._expires = started + self.ttl
+        if self.heartbeat:
+            self._thread = threading.Thread(target=self._beat, daemon=True)
+            self._thread.start()
+
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+        self.release()
+
+    def _beat(self):
+        # runs in its own thread and so uses its own database connection,
+        # which is closed when done; waits are cut short so a failing lease
+        # gets one last try right as it expires
+        try:
+            while not self._stop.wait(min(self.heartbeat,
+                    max(0, self._expires - time.monotonic()))):
+                close_old_connections()
+                attempted = time.monotonic()
+                try:
+                    if not self.renew():
+                        break
+
+                    self._expires = attempted + self.ttl
+                except Exception:
+                    logger.exception('Renewing lease on lock "%s" failed',
+                        self.name)
+                    if time.monotonic() >= self._expires:
+                        self.lost = True
+                        break
+        finally:
+            connections.close_all()
+
+    def renew(self):
+        """Extends the lease by ``ttl`` seconds from now.
+
+        :returns:
+            True if the lease is still held, False if it expired and was taken
+            by someone else, in which case :attr:`Lease.lost` is also set
+        """
+        if not Lock.renew_lease(self.name, self.owner, self.ttl,
+                using=self.using):
+            self.lost = True
+
+        return not self.lost
+
+    def release(self):
+        """Gives up the lease, safe to call more than once."""
+        if self.owner is not None and not self.lost:
+            Lock.release_lease(self.name, self.owner, using=self.using)
+
+        self.owner = None
 
 # ============================================================================
 # Misc
@@ -81,6 +1546,7 @@ class _ChoicesType(type):
             # it already -- this allows grandchildren of Choices to override
             # their parent's values
             cls._choices_hash = {}
+            cls._choices_names = {}
 
         # values defined in the class (not in parent) are defined in __dict__,
         # loop through them and update _choices_hash; this will override
@@ -101,17 +1567,47 @@ class _ChoicesType(type):
                 # part and set the content hash to be the second part
                 setattr(cls, name, value[0])
                 cls._choices_hash[value[0]] = value[1]
+                cls._choices_names[name] = value[0]
             else:
                 # value is not a tuple, create a default choice name based on
                 # the class attribute
                 pieces = [x.capitalize() for x in name.split('_')]
                 cls._choices_hash[value] = ' '.join(pieces)
+                cls._choices_names[name] = value
 
+        metacls._compile(cls)
         return cls
 
+    def _compile(cls):
+        # builds the lookups once rather than on every use; they are stored
+        # on the class that owns _choices_hash, which is shared with (and
+        # changed by) its children, so everyone inherits the same results
+        for owner in cls.__mro__:
+            if '_choices_hash' in owner.__dict__:
+                break
+
+        owner._choices = tuple(owner._choices_hash.items())
+        owner._choices_labels = {label:value for value, label in
+            owner._choices}
+
+    @property
+    def choices(cls):
+        """Tuple of ``(value, label)`` pairs for a Django field's
+        ``choices`` argument."""
+        return cls._choices
+
     def __iter__(cls):
-        for name, value in cls._choices_hash.items():
-            yield (name, value)
+        return iter(cls._choices)
+
+    def __len__(cls):
+        return len(cls._choices)
+
+    def __contains__(cls, value):
+        try:
+            return value in cls._choices_hash
+        except TypeError:
+            # unhashable things can't be choices
+            return False
 
 
 class Choices(metaclass=_ChoicesType):
@@ -162,15 +1658,150 @@ class Choices(metaclass=_ChoicesType):
 
         >> list(Colours)
         [('r', 'Red'), ('b', 'Even More Blue'), ('g', 'Green')]
+
+    The ``(value, label)`` pairs and the lookups are built once when the
+    class is created, so iterating, ``len()``, ``in`` and the lookup methods
+    don't redo any work.
+
+    .. code-block:: python
+
+        >> Colours.choices
+        (('r', 'Red'), ('b', 'Blueish'))
+        >> 'r' in Colours
+        True
+        >> Colours.get_by_label('Blueish')
+        'b'
+        >> Colours.get_by_name('RED')
+        'r'
     """
     @classmethod
     def get_value(cls, key):
+        """Returns the label for the given value.
+
+        :raises:
+            ``KeyError`` if ``key`` isn't one of the values
+        """
         return cls._choices_hash[key]
 
+    @classmethod
+    def get_by_label(cls, label):
+        """Returns the value with the given label.
+
+        :raises:
+            ``KeyError`` if no choice has that label
+        """
+        return cls._choices_labels[label]
+
+    @classmethod
+    def get_by_name(cls, name):
+        """Returns the value of the member with the given attribute name.
+
+        :raises:
+            ``KeyError`` if there is no such member
+        """
+        return cls._choices_names[name]
+
+    @classmethod
+    def is_valid(cls, value):
+        """Returns True if ``value`` is one of the choices' values."""
+        return value in cls
+
 # ----------------------------------------------------------------------------
 
 # QuerySetChain
 #
+_VALUES_ITERABLES = (ValuesIterable, ValuesListIterable,
+    FlatValuesListIterable, NamedValuesListIterable)
+
+# values JSON can't hold exactly are stored in cursors as [tag, text] pairs;
+# datetime comes before its parent class date
+_CURSOR_TYPES = (
+    ('datetime', datetime, datetime.isoformat, datetime.fromisoformat),
+    ('date', date, date.isoformat, date.fromisoformat),
+    ('time', dt_time, dt_time.isoformat, dt_time.fromisoformat),
+    ('timedelta', timedelta, lambda value: value // timedelta(microseconds=1),
+        lambda value: timedelta(microseconds=value)),
+    ('decimal', Decimal, str, Decimal),
+    ('uuid', uuid.UUID, str, uuid.UUID),
+)
+
+
+# collations that compare text by code point, the way Python compares strings
+_BINARY_COLLATIONS = {
+    'mysql':'utf8mb4_bin',
+    'oracle':'BINARY',
+    'postgresql':'C',
+    'sqlite':'BINARY',
+}
+
+
+def _encode_cursor_value(value):
+    for tag, kind, encode, _ in _CURSOR_TYPES:
+        if isinstance(value, kind):
+            return [tag, encode(value)]
+
+    if value is not None and not isinstance(value, (str, int, float)):
+        raise ValueError('Cannot store %r in a cursor.' % (value, ))
+
+    return [None, value]
+
+
+def _decode_cursor_value(item):
+    tag, value = item
+    if tag is None:
+        return value
+
+    for name, _, _, decode in _CURSOR_TYPES:
+        if name == tag:
+            return decode(value)
+
+    raise ValueError('Unknown cursor value type "%s".' % tag)
+
+
+def _column_types(qs):
+    # internal types of the columns of a values() or values_list() queryset,
+    # following relations to the field they point at; None if a column's
+    # type can't be worked out
+    query = qs.query.chain()
+    types = []
+    for name in qs._fields:
+        try:
+            field = query.resolve_ref(name).output_field
+        except FieldError:
+            return None
+
+        while field.is_relation:
+            field = field.target_field
+
+        types.append(field.get_internal_type())
+
+    return types
+
+
+def _count_and_close(qs):
+    # counts in a worker thread, closing the thread's connection afterwards
+    # so it isn't left open in the thread pool
+    try:
+        return qs.count()
+    finally:
+        connections[qs.db].close()
+
+
+class _Descending:
+    # wraps part of a sort key so it compares in reverse, for merging on
+    # descending fields
+    __slots__ = ('value', )
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+
 # borrowed and modified from:
 #   http://stackoverflow.com/questions/431628/
 #   by: http://stackoverflow.com/users/15770/akaihola
@@ -178,41 +1809,549 @@ class QuerySetChain:
     """
     Chains together multiple querysets (possibly of different models) and 
     behaves as one queryset.  Supports minimal methods needed for use with
-    django.core.paginator.  Does not support re-ordering or re-filtering
-    across the set.
+    django.core.paginator.  Does not support re-filtering across the set,
+    re-ordering is done with :meth:`QuerySetChain.order_by`.
 
     .. code-block:: python
 
         q1 = Thing.objects.filter(foo)
         q2 = Stuff.objects.filter(bar)
         qsc = QuerySetChain(q1, q2)
+
+    When every subqueryset is a ``.values()`` or ``.values_list()`` queryset
+    with the same number and types of columns (and the same names for
+    ``.values()``), and the chain is either ordered with
+    :meth:`QuerySetChain.order_by` or none of its members are ordered, the
+    chain is run as a single ``UNION ALL`` statement: slicing is one query
+    with a single ``LIMIT``/``OFFSET`` and counting is one ``COUNT``.  The
+    database does the ordering for these, so rows with equal sort keys may
+    not come back in chain order.
+
+    .. code-block:: python
+
+        q1 = Thing.objects.values_list('id', 'name')
+        q2 = Stuff.objects.values_list('id', 'title')
+        qsc = QuerySetChain(q1, q2)
+
+    Like a queryset, the chain caches what it has read: each subqueryset is
+    counted at most once, and with ``cache_size`` set, the results of the
+    most recently fetched slices are kept and reused.  Use ``_clone()`` for
+    a copy with empty caches when the underlying data may have changed.
+
+    :param subquerysets:
+        Querysets to chain together
+    :param cache_size:
+        Number of fetched slices to keep, least recently used ones are
+        dropped first.  Defaults to 0, meaning slices aren't kept.
     """
 
-    def __init__(self, *subquerysets):
+    def __init__(self, *subquerysets, cache_size=0):
         self.querysets = subquerysets
+        self.cache_size = cache_size
+        self.ordering = ()
+
+        self._counts = [None] * len(subquerysets)
+        self._offsets = None
+        self._total = None
+        self._results = OrderedDict()
+
+    def _count(self, position):
+        # count of a single subqueryset, cached
+        if self._counts[position] is None:
+            self._counts[position] = self.querysets[position].count()
+
+        return self._counts[position]
 
     def count(self):
         """
         Performs a .count() for all subquerysets and returns the number of
-        records as an integer.
+        records as an integer.  The counts are cached, calling this again
+        doesn't query the database.
+        """
+        if self._total is None:
+            if self._union is not None:
+                self._total = self._union.count()
+            else:
+                # offsets[i] is where subqueryset i starts in the chain, the
+                # last entry is the total
+                offsets = [0]
+                for position in range(len(self.querysets)):
+                    offsets.append(offsets[-1] + self._count(position))
+
+                self._offsets = offsets
+                self._total = offsets[-1]
+
+        return self._total
+
+    async def acount(self, concurrent=False):
+        """Async version of :meth:`QuerySetChain.count`.  By default the
+        subquerysets that haven't been counted yet are counted one after
+        another on the request's connection, in a single hop to Django's
+        async ORM thread.
+
+        With ``concurrent=True`` each count runs at the same time in its own
+        worker thread, so counting takes about as long as the slowest count
+        rather than their sum.  This is a trade-off: every call opens and
+        closes a new database connection per subqueryset, bypassing
+        ``CONN_MAX_AGE`` reuse, adding connection setup time and using up
+        more of the database's connection limit.  The connections are also
+        outside of any transaction the request has open, so they don't see
+        its uncommitted changes and may disagree with :meth:`count`.  Worth
+        it for a few slow counts, not for many fast ones.
+
+        :param concurrent:
+            If True, count each subqueryset on its own connection at the same
+            time.  Defaults to False.
         """
-        return sum(qs.count() for qs in self.querysets)
+        if self._total is None:
+            if self._union is not None:
+                self._total = await self._union.acount()
+            else:
+                missing = [position for position, count
+                    in enumerate(self._counts) if count is None]
+                querysets = [self.querysets[position] for position in missing]
+                if concurrent and len(querysets) > 1:
+                    counts = await asyncio.gather(*[sync_to_async(
+                        _count_and_close, thread_sensitive=False)(qs)
+                        for qs in querysets])
+                else:
+                    counts = await sync_to_async(lambda: [qs.count()
+                        for qs in querysets])()
+
+                for position, count in zip(missing, counts):
+                    self._counts[position] = count
+
+                # everything is cached, no queries are made
+                self.count()
+
+        return self._total
+
+    @cached_property
+    def _union(self):
+        # A single "UNION ALL" queryset equivalent to the chain, or None if
+        # the subquerysets can't be combined.  Only done for values() and
+        # values_list() querysets on the same database with the same kind,
+        # number and types of explicitly named columns; values() and named
+        # values_list() also need the same names as the rows take them from
+        # the first queryset
+        if len(self.querysets) < 2:
+            return None
+
+        first = self.querysets[0]
+        iterable = first._iterable_class
+        if iterable not in _VALUES_ITERABLES:
+            return None
+
+        for qs in self.querysets:
+            if qs._iterable_class is not iterable or not qs._fields or \
+                    len(qs._fields) != len(first._fields) or \
+                    qs.db != first.db or qs.query.is_sliced or \
+                    qs.query.combinator:
+                return None
+
+            if iterable in (ValuesIterable, NamedValuesListIterable) and \
+                    qs._fields != first._fields:
+                return None
+
+        if self.ordering:
+            if any(field.lstrip('-') not in first._fields
+                    for field in self.ordering):
+                # ordering on something that isn't a column, merge instead
+                return None
+        elif any(qs.ordered for qs in self.querysets):
+            # each subqueryset keeps its own order in an unordered chain,
+            # which a compound statement can't do
+            return None
+
+        # databases like PostgreSQL refuse to combine columns of different
+        # types
+        types = _column_types(first)
+        if types is None or any(_column_types(qs) != types
+                for qs in self.querysets[1:]):
+            return None
+
+        # compound statements can't have ordering in their parts
+        union = first.order_by().union(*[qs.order_by()
+            for qs in self.querysets[1:]], all=True)
+        if self.ordering:
+            union = union.order_by(*self.ordering)
+
+        return union
 
     def _clone(self):
         "Returns a clone of this queryset chain"
-        return self.__class__(*self.querysets)
+        clone = self.__class__(*self.querysets, cache_size=self.cache_size)
+        clone.ordering = self.ordering
+        return clone
+
+    def order_by(self, *fields):
+        """
+        Returns a new chain where each subqueryset is ordered by the given
+        fields and the results are merged so the whole chain is in that
+        order.  The merge is lazy: for a slice ending at row N, each
+        subqueryset is only asked for its first N rows.
+
+        .. code-block:: python
+
+            feed = QuerySetChain(Comment.objects.all(), Like.objects.all())
+            latest = feed.order_by('-created')[:20]
+
+        Every subqueryset must return model instances (or ``.values()``
+        dictionaries) that have the fields, ``__`` lookups are followed on
+        instances.  Values used for ordering shouldn't be NULL, as ``None``
+        can't be compared in Python.
+
+        :param fields:
+            Field names, prefixed with "-" for descending order
+        """
+        if any(field.startswith('?') for field in fields):
+            raise ValueError('Random ordering is not supported.')
+
+        ordered = self.__class__(*[qs.order_by(*fields)
+            for qs in self.querysets], cache_size=self.cache_size)
+        ordered.ordering = fields
+        return ordered
+
+    def _sort_values(self, row):
+        # values of a row's ordering fields
+        values = []
+        for field in self.ordering:
+            name = field.lstrip('-')
+            if isinstance(row, dict):
+                values.append(row[name])
+            else:
+                values.append(get_obj_attr(row, name))
+
+        return values
+
+    def _merge_key(self, row):
+        # sort key of a row for merging ordered subquerysets
+        return tuple(_Descending(value) if field.startswith('-') else value
+            for field, value in zip(self.ordering, self._sort_values(row)))
+
+    def _merged(self, sources):
+        # lazily merges rows from "sources", one ordered iterable per
+        # subqueryset; the subqueryset's position breaks ties so rows are
+        # never compared and equal keys come out in chain order
+        def decorated(position, rows):
+            for row in rows:
+                yield (self._merge_key(row), position, row)
+
+        merged = heapq.merge(*[decorated(position, rows)
+            for position, rows in enumerate(sources)])
+        return (row for _, _, row in merged)
+
+    def iterator(self, chunk_size=None):
+        """Streams the records of the chain without caching them, for going
+        through more rows than fit in memory.  Each subqueryset is read with
+        ``QuerySet.iterator()``, which uses server side cursors on databases
+        that support them and fetches ``chunk_size`` rows at a time.  Ordered
+        chains have the streams merged, so one cursor per subqueryset is open
+        at once.
+
+        Unlike iterating the subquerysets themselves, nothing is kept in
+        their result caches and nothing goes in the chain's slice cache.
+
+        .. code-block:: python
+
+            for row in qsc.iterator(chunk_size=500):
+                writer.writerow(row)
+
+        :param chunk_size:
+            Number of rows fetched from the database at a time, passed to
+            ``QuerySet.iterator()``.  Defaults to None, which uses Django's
+            default.
+        :returns:
+            Iterator over the records
+        """
+        if self._union is not None:
+            return self._union.iterator(chunk_size=chunk_size)
+
+        streams = [qs.iterator(chunk_size=chunk_size)
+            for qs in self.querysets]
+        if self.ordering:
+            return self._merged(streams)
+
+        return chain(*streams)
+
+    async def aiterator(self, chunk_size=None):
+        """Async version of :meth:`QuerySetChain.iterator`, rows are read in
+        the sync iterator ``chunk_size`` at a time (2000 if not given) using
+        ``sync_to_async``, the same way ``QuerySet.aiterator()`` does."""
+        rows = self.iterator(chunk_size=chunk_size)
+        while True:
+            chunk = await sync_to_async(list)(islice(rows, chunk_size or 2000))
+            if not chunk:
+                break
+
+            for row in chunk:
+                yield row
+
+    def __aiter__(self):
+        """Supports ``async for`` over the chain, streaming it with
+        :meth:`QuerySetChain.aiterator`.
+
+        .. code-block:: python
+
+            async def feed(request):
+                async for row in qsc:
+                    ...
+        """
+        return self.aiterator()
+
+    def cursor_page(self, size, cursor=None):
+        """Fetches a page of an ordered chain using keyset (cursor)
+        pagination.  Instead of an offset, each page remembers the sort key of
+        its last row in an opaque cursor string, and the next page asks each
+        subqueryset only for rows that sort after it.  Every page costs one
+        ``WHERE ... LIMIT`` query per subqueryset no matter how deep it is,
+        which suits infinite scrolling.
+
+        Rows with equal sort keys are ordered by their position in the chain
+        and then by primary key, so ``.values()`` subquerysets must include
+        ``'pk'``.  Values used for ordering shouldn't be NULL.  The cursor
+        keeps values at full precision, including microseconds, with their
+        type so dates, times, decimals and UUIDs come back as themselves.
+
+        Pages are merged in Python and the next page is picked by the
+        database, so sort keys have to compare the same way in both.
+        Numbers, dates and times do.  Text fields are compared with a binary
+        collation (``C`` on PostgreSQL, ``utf8mb4_bin`` on MySQL, ``BINARY``
+        on SQLite and Oracle), meaning they sort by code point like Python
+        strings rather than by the column's collation: "B" comes before "a".
+        Text keys on other databases raise ``ValueError``.
+
+        .. code-block:: python
+
+            feed = QuerySetChain(Comment.objects.all(), Like.objects.all())
+            feed = feed.order_by('-created')
+
+            rows, cursor = feed.cursor_page(20)
+            while cursor:
+                rows, cursor = feed.cursor_page(20, cursor)
+
+        :param size:
+            Maximum number of rows in the page
+        :param cursor:
+            Cursor returned with the previous page, or None for the first
+            page.  Defaults to None.
+        :returns:
+            Tuple with the list of rows in the page and the cursor for the
+            next page, which is None if this is the last page
+        :raises ValueError:
+            If the chain hasn't been ordered with
+            :meth:`QuerySetChain.order_by`, the cursor is invalid, or a text
+            sort key is used on a database without a known binary collation
+        """
+        if not self.ordering:
+            raise ValueError('Cursor pagination requires an ordered chain.')
+
+        after = None
+        if cursor is not None:
+            after = self._decode_cursor(cursor)
+
+        # one extra row says whether there is a next page
+        def decorated(position, qs, keys):
+            qs = qs.order_by(*keys, 'pk')
+            if after is not None:
+                qs = qs.filter(self._after_cursor(keys, position, *after))
+
+            for row in qs[:size + 1]:
+                pk = row['pk'] if isinstance(row, dict) else row.pk
+                yield (self._merge_key(row), position, pk, row)
+
+        keyed = [self._cursor_keys(qs) for qs in self.querysets]
+        merged = heapq.merge(*[decorated(position, qs, keys)
+            for position, (qs, keys) in enumerate(keyed)])
+        page = list(islice(merged, size + 1))
+
+        next_cursor = None
+        if len(page) > size:
+            page = page[:size]
+            _, position, pk, row = page[-1]
+            values = [_encode_cursor_value(value)
+                for value in self._sort_values(row)]
+            data = json.dumps([values, position, _encode_cursor_value(pk)])
+            next_cursor = urlsafe_b64encode(data.encode('utf-8')).decode(
+                'ascii')
+
+        return [row for _, _, _, row in page], next_cursor
+
+    def _decode_cursor(self, cursor):
+        # returns the (sort values, position, pk) stored in a cursor
+        try:
+            data = urlsafe_b64decode(cursor.encode('ascii'))
+            values, position, pk = json.loads(data)
+            if len(values) != len(self.ordering) or \
+                    not 0 <= position < len(self.querysets):
+                raise ValueError()
+
+            values = [_decode_cursor_value(value) for value in values]
+            pk = _decode_cursor_value(pk)
+        except (TypeError, ValueError):
+            raise ValueError('Invalid cursor.')
+
+        return values, position, pk
+
+    def _cursor_keys(self, qs):
+        # returns the subqueryset and the ordering terms to page it by; text
+        # fields are replaced by aliases using a binary collation so the
+        # database sorts them the same way Python does
+        vendor = connections[qs.db].vendor
+        keys = []
+        aliases = {}
+        for index, field in enumerate(self.ordering):
+            name = field.lstrip('-')
+            try:
+                output = qs.query.chain().resolve_ref(name).output_field
+            except FieldError:
+                output = None
+
+            if isinstance(output, (models.CharField, models.TextField)):
+                collation = _BINARY_COLLATIONS.get(vendor)
+                if collation is None:
+                    raise ValueError('Text cursor keys are not supported on '
+                        '%s.' % vendor)
+
+                alias = '_awl_key%d' % index
+                aliases[alias] = Collate(F(name), collation)
+                name = alias
+
+            keys.append('-' + name if field.startswith('-') else name)
+
+        if aliases:
+            qs = qs.alias(**aliases)
+
+        return qs, keys
+
+    def _after_cursor(self, keys, position, values, last_position, last_pk):
+        # filter for rows in the subqueryset at "position" that come after the
+        # cursor: later on a leading ordering key with the ones before it
+        # equal, or tied on all of them and later in the chain or by pk
+        conditions = []
+        equal = Q()
+        for field, value in zip(keys, values):
+            name = field.lstrip('-')
+            lookup = '__lt' if field.startswith('-') else '__gt'
+            conditions.append(equal & Q(**{name + lookup:value}))
+            equal &= Q(**{name:value})
+
+        if position > last_position:
+            conditions.append(equal)
+        elif position == last_position:
+            conditions.append(equal & Q(pk__gt=last_pk))
+
+        result = conditions[0]
+        for condition in conditions[1:]:
+            result |= condition
+
+        return result
 
     def _all(self):
         "Iterates records in all subquerysets"
+        if self._union is not None:
+            return iter(self._union)
+
+        if self.ordering:
+            return self._merged(self.querysets)
+
         return chain(*self.querysets)
 
+    def _window(self, start, stop):
+        # Fetches rows [start:stop] of the chain, using the result cache if
+        # it is turned on
+        if start < 0 or (stop is not None and stop < 0):
+            raise ValueError('Negative indexing is not supported.')
+
+        key = (start, stop)
+        if key in self._results:
+            self._results.move_to_end(key)
+            return list(self._results[key])
+
+        if self._union is not None:
+            results = list(self._union[start:stop])
+        elif self.ordering:
+            results = list(islice(self._merged([qs[:stop]
+                for qs in self.querysets]), start, stop))
+        else:
+            results = self._chained_window(start, stop)
+
+        if self.cache_size:
+            self._results[key] = results
+            if len(self._results) > self.cache_size:
+                self._results.popitem(last=False)
+
+            results = list(results)
+
+        return results
+
+    def _chained_window(self, start, stop):
+        # Subquerysets entirely before "start" are skipped using their
+        # counts, the rest have the LIMIT/OFFSET pushed into their SQL; a
+        # subqueryset returning fewer rows than asked for is exhausted so its
+        # count isn't needed
+        first = 0
+        skip = start
+        if self._offsets is not None:
+            # everything has been counted, jump straight to the subqueryset
+            # containing "start"
+            first = max(bisect_right(self._offsets, start) - 1, 0)
+            skip = start - self._offsets[first]
+
+        results = []
+        for position in range(first, len(self.querysets)):
+            qs = self.querysets[position]
+            wanted = None if stop is None else stop - start - len(results)
+            if wanted is not None and wanted <= 0:
+                break
+
+            if skip or self._counts[position] == 0:
+                size = self._count(position)
+                if size <= skip:
+                    skip -= size
+                    continue
+
+            if wanted is None:
+                rows = list(qs[skip:])
+            else:
+                rows = list(qs[skip:skip + wanted])
+
+            if wanted is None or len(rows) < wanted:
+                # read to the end, so this is the size of the subqueryset
+                self._counts[position] = skip + len(rows)
+
+            results.extend(rows)
+            skip = 0
+
+        return results
+
     def __getitem__(self, index):
         """
         Retrieves an item or slice from the chained set of results from all
-        subquerysets.
+        subquerysets.  Only the subquerysets that overlap the requested rows
+        are fetched, with the slice turned into ``LIMIT``/``OFFSET`` on each,
+        so a deep page costs about the same as the first one.
         """
         if type(index) is slice:
-            return list(islice(self._all(), index.start, index.stop,
-                index.step or 1))
+            results = self._window(index.start or 0, index.stop)
+            if index.step:
+                results = results[::index.step]
+
+            return results
         else:
-            return next(islice(self._all(), index, index+1))
+            results = self._window(index, index + 1)
+            if not results:
+                raise IndexError('QuerySetChain index out of range')
+
+            return results[0]
+
+    async def agetitem(self, index):
+        """Async version of indexing and slicing the chain, takes an integer
+        or a ``slice``.
+
+        .. code-block:: python
+
+            page = await qsc.agetitem(slice(20, 40))
+            first = await qsc.agetitem(0)
+        """
+        return await sync_to_async(self.__getitem__)(index)